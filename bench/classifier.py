@@ -0,0 +1,166 @@
+"""Классификатор формата картинки: старые циклы по подстрокам против PromptClassifier.
+
+Запуск из корня репозитория:
+
+    python -m bench.classifier --runs 20000
+
+Сначала сверяет оба варианта с размеченным корпусом промптов (код возврата 1,
+если новый ошибается), затем меряет время на вызов — на штатной таблице и на
+таблице, раздутой до нескольких сотен ключевых слов.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from main import DEFAULT_IMAGE_SIZE, IMAGE_SIZE_RULES, MARCH8_TEMPLATES, PromptClassifier  # noqa: E402
+
+# (промпт, ожидаемая ориентация)
+CORPUS = [
+    ("девушка в полный рост на фоне цветов", "vertical"),
+    ("full body shot, standing on a rooftop", "vertical"),
+    ("full-body photo in a red dress", "vertical"),
+    ("она идёт по осенней улице", "vertical"),
+    ("идет по мосту под дождём", "vertical"),
+    ("woman walking in the rain", "vertical"),
+    ("двое стоят у окна", "vertical"),
+    ("mountain landscape at sunset", "landscape"),
+    ("панорама ночного города", "landscape"),
+    ("в городе ночью, неоновые огни", "landscape"),
+    ("на пляже у моря", "landscape"),
+    ("прогулка по лесу", "landscape"),
+    ("лестница в небо", "landscape"),
+    ("wide shot of the streets of Paris", "landscape"),
+    ("on the beach near the ocean", "landscape"),
+    ("city skyline behind her", "landscape"),
+    ("деревенская природа, поле ромашек", "landscape"),
+    ("в горах, снежные вершины", "landscape"),
+    ("portrait in soft window light", "portrait"),
+    ("close-up of her face with freckles", "portrait"),
+    ("Close up, studio headshot", "portrait"),
+    ("селфи в зеркале, крупный план", "portrait"),
+    ("портрет в стиле Рембрандта", "portrait"),
+    ("фото крупным планом", "portrait"),
+    ("вертикальный кадр с цветами", "portrait"),
+    ("в профиль, мягкий свет", "portrait"),
+    # Подстроки, на которых ошибались старые циклы
+    ("a widely admired painting style", "square"),
+    ("винтовая лестница в замке", "square"),
+    ("her husky puppy on a sofa", "square"),
+    ("electricity sparks, cyberpunk style", "square"),
+    ("с широкой улыбкой и букетом", "square"),
+    ("surface of polished marble", "square"),
+    ("a cat in a hat", "square"),
+    ("в стиле аниме", "square"),
+    *[(template["prompt"], "square") for template in MARCH8_TEMPLATES.values()],
+]
+
+
+def legacy_detect_image_size(prompt: str) -> tuple[str, str]:
+    prompt_lower = prompt.lower()
+    vertical_keywords = [
+        "full body", "full-body", "standing", "walking", "в полный рост",
+        "стоит", "идёт", "идет", "whole body", "весь рост"
+    ]
+    landscape_keywords = [
+        "landscape", "panorama", "wide", "city", "street", "nature", "ocean",
+        "пейзаж", "панорама", "широкий", "горизонтальный", "город", "улица",
+        "природа", "океан", "море", "beach", "пляж", "forest", "лес",
+        "mountain", "гора", "sky", "небо"
+    ]
+    portrait_keywords = [
+        "portrait", "close-up", "closeup", "face", "headshot", "selfie",
+        "портрет", "крупный план", "лицо", "вертикальный",
+        "profile", "профиль"
+    ]
+    for kw in vertical_keywords:
+        if kw in prompt_lower:
+            return "portrait_16_9", "1024x1536"
+    for kw in landscape_keywords:
+        if kw in prompt_lower:
+            return "landscape_4_3", "1536x1024"
+    for kw in portrait_keywords:
+        if kw in prompt_lower:
+            return "portrait_4_3", "1024x1536"
+    return "square_hd", "1024x1024"
+
+
+def orientation_by_size(rules: list[dict]) -> dict[str, str]:
+    return {rule["fal_size"]: rule["orientation"] for rule in [*rules, DEFAULT_IMAGE_SIZE]}
+
+
+def inflated_rules(extra: int) -> list[dict]:
+    # Случайные «слова» на латинице, которых нет в корпусе: меряем только рост таблицы
+    rng = random.Random(0)
+    rules = [dict(rule, keywords=list(rule["keywords"])) for rule in IMAGE_SIZE_RULES]
+    for i in range(extra):
+        word = "".join(rng.choice("bcdfghjklmnpqrstvwxz") for _ in range(rng.randint(5, 10)))
+        rules[i % len(rules)]["keywords"].append(word + ("*" if i % 3 == 0 else ""))
+    return rules
+
+
+def substring_loops(rules: list[dict]):
+    # Тот же алгоритм, что в старых циклах, но по произвольной таблице
+    tables = [[keyword.rstrip("*") for keyword in rule["keywords"]] for rule in rules]
+
+    def detect(prompt: str) -> int:
+        prompt_lower = prompt.lower()
+        for index, keywords in enumerate(tables):
+            for kw in keywords:
+                if kw in prompt_lower:
+                    return index
+        return -1
+
+    return detect
+
+
+def time_per_call(func, prompts: list[str], runs: int) -> float:
+    started = time.perf_counter()
+    for i in range(runs):
+        func(prompts[i % len(prompts)])
+    return (time.perf_counter() - started) / runs * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20000)
+    parser.add_argument("--extra-keywords", type=int, default=500)
+    args = parser.parse_args()
+
+    classifier = PromptClassifier(IMAGE_SIZE_RULES, DEFAULT_IMAGE_SIZE)
+    legacy_orientation = orientation_by_size(IMAGE_SIZE_RULES)
+    legacy_correct = 0
+    mistakes = []
+    for prompt, expected in CORPUS:
+        if legacy_orientation[legacy_detect_image_size(prompt)[0]] == expected:
+            legacy_correct += 1
+        match = classifier.classify(prompt)
+        if match.orientation != expected:
+            mistakes.append((prompt[:60], expected, match.orientation, match.keyword))
+    print(f"Корпус: {len(CORPUS)} промптов")
+    print(f"  старые циклы:     {legacy_correct}/{len(CORPUS)} верно")
+    print(f"  PromptClassifier: {len(CORPUS) - len(mistakes)}/{len(CORPUS)} верно")
+    for prompt, expected, got, keyword in mistakes:
+        print(f"    ✗ {prompt!r}: ожидалось {expected}, получено {got} ({keyword!r})")
+
+    prompts = [prompt for prompt, _ in CORPUS]
+    big_rules = inflated_rules(args.extra_keywords)
+    big = PromptClassifier(big_rules, DEFAULT_IMAGE_SIZE)
+    keywords = sum(len(rule["keywords"]) for rule in IMAGE_SIZE_RULES)
+    print(f"Время на вызов, {args.runs} вызовов:")
+    for name, func in [
+        ("старые циклы, 46 слов", legacy_detect_image_size),
+        (f"циклы по подстрокам, {keywords + args.extra_keywords} слов", substring_loops(big_rules)),
+        (f"PromptClassifier, {keywords} слов", classifier.classify),
+        (f"PromptClassifier, {keywords + args.extra_keywords} слов", big.classify),
+    ]:
+        print(f"  {name:<32} {time_per_call(func, prompts, args.runs):.1f} мкс")
+    return 1 if mistakes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
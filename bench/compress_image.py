@@ -0,0 +1,92 @@
+"""Микробенчмарк предобработки фото: старый compress_image против preprocess_image.
+
+Запуск из корня репозитория:
+
+    python -m bench.compress_image --runs 10
+
+Каждый вариант выполняется в отдельном процессе, чтобы пиковая память
+(ru_maxrss) одного не смешивалась с другим.
+"""
+import argparse
+import base64
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+from io import BytesIO
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from PIL import Image  # noqa: E402
+
+
+def make_phone_photo(width: int = 4032, height: int = 3024) -> bytes:
+    # Градиент + шум сжимается примерно как настоящее фото с телефона
+    base = Image.radial_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge("RGB", (base, noise, Image.blend(base, noise, 0.5)))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: поворот на 90°, как у вертикальных снимков
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=92, exif=exif)
+    return buffer.getvalue()
+
+
+def legacy_compress_image(image_bytes: bytes, max_size: int = 1024) -> str:
+    img = Image.open(BytesIO(image_bytes))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_size, max_size), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def run_variant(name: str, image_bytes: bytes, runs: int) -> dict:
+    if name == "legacy":
+        func = legacy_compress_image
+    else:
+        from main import preprocess_image as func
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_times = []
+    for _ in range(runs):
+        started = time.process_time()
+        func(image_bytes)
+        cpu_times.append(time.process_time() - started)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "name": name,
+        "cpu_ms_median": statistics.median(cpu_times) * 1000,
+        "cpu_ms_max": max(cpu_times) * 1000,
+        "peak_rss_delta_mb": (peak_rss - baseline_rss) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    args = parser.parse_args()
+
+    # ru_maxrss наследуется дочерним процессом, поэтому пулы создаются
+    # до того, как родитель раздуется на генерации тестового снимка
+    ctx = multiprocessing.get_context("spawn")
+    pools = {name: ctx.Pool(1) for name in ("legacy", "current")}
+    image_bytes = make_phone_photo(args.width, args.height)
+    print(f"Вход: {args.width}x{args.height} JPEG, {len(image_bytes) / 1024 / 1024:.1f} МБ")
+
+    for name, pool in pools.items():
+        with pool:
+            result = pool.apply(run_variant, (name, image_bytes, args.runs))
+        print(
+            f"{result['name']:>8}: CPU медиана {result['cpu_ms_median']:.1f} мс, "
+            f"макс {result['cpu_ms_max']:.1f} мс, пик RSS +{result['peak_rss_delta_mb']:.1f} МБ"
+        )
+
+
+if __name__ == "__main__":
+    main()
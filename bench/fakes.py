@@ -0,0 +1,283 @@
+"""Локальные заглушки внешних сервисов для нагрузочных прогонов без сети.
+
+Запуск отдельно:
+
+    python -m bench.fakes --port 8081 --fal-latency 2 --error-rate 0.05
+
+и затем бот с FAL_QUEUE_URL=http://127.0.0.1:8081,
+TELEGRAM_API_URL=http://127.0.0.1:8081 и OPENAI_BASE_URL=http://127.0.0.1:8081/v1 —
+все три API обслуживает один сервер. GET /_stats возвращает счётчики вызовов.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+import zlib
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+
+def make_jpeg(width: int = 1280, height: int = 960, seed: int = 0) -> bytes:
+    img = Image.merge("RGB", (
+        Image.radial_gradient("L").resize((width, height)),
+        Image.linear_gradient("L").resize((width, height)),
+        Image.effect_noise((width, height), 20),
+    ))
+    # Разные file_id должны давать разные фото, иначе сработает кэш результатов
+    img.paste((seed % 256, seed // 256 % 256, seed // 65536 % 256), (0, 0, 64, 64))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_png(width: int = 1024, height: int = 1024) -> bytes:
+    img = Image.merge("RGB", (
+        Image.linear_gradient("L").resize((width, height)),
+        Image.radial_gradient("L").resize((width, height)),
+        Image.effect_noise((width, height), 30),
+    ))
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeFal:
+    """Очередь fal.ai: submit → status → result, плюс CDN с готовой картинкой."""
+
+    def __init__(self, latency: float = 2.0, jitter: float = 0.5, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests: dict[str, dict] = {}
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0}
+        self.image = make_png()
+
+    def add_routes(self, app: web.Application):
+        app.router.add_get("/cdn/{name}", self.cdn)
+        app.router.add_post("/{owner}/{model}", self.submit)
+        app.router.add_get("/{owner}/{model}/requests/{request_id}/status", self.status)
+        app.router.add_put("/{owner}/{model}/requests/{request_id}/cancel", self.cancel)
+        app.router.add_get("/{owner}/{model}/requests/{request_id}", self.result)
+
+    async def submit(self, request: web.Request) -> web.Response:
+        await request.json()
+        request_id = uuid.uuid4().hex
+        delay = max(0.0, random.gauss(self.latency, self.jitter))
+        self.requests[request_id] = {
+            "ready_at": time.monotonic() + delay,
+            "failed": random.random() < self.error_rate,
+        }
+        self.stats["submitted"] += 1
+        base = f"{request.scheme}://{request.host}{request.path}/requests/{request_id}"
+        return web.json_response({
+            "request_id": request_id,
+            "status_url": f"{base}/status",
+            "response_url": base,
+            "cancel_url": f"{base}/cancel",
+        })
+
+    async def status(self, request: web.Request) -> web.Response:
+        job = self.requests.get(request.match_info["request_id"])
+        if job is None:
+            return web.json_response({"detail": "not found"}, status=404)
+        if time.monotonic() < job["ready_at"]:
+            return web.json_response({"status": "IN_PROGRESS"}, status=202)
+        return web.json_response({"status": "COMPLETED"})
+
+    async def cancel(self, request: web.Request) -> web.Response:
+        if self.requests.pop(request.match_info["request_id"], None) is not None:
+            self.stats["cancelled"] += 1
+        return web.json_response({"status": "CANCELLATION_REQUESTED"})
+
+    async def result(self, request: web.Request) -> web.Response:
+        request_id = request.match_info["request_id"]
+        job = self.requests.pop(request_id, None)
+        if job is None:
+            return web.json_response({"detail": "not found"}, status=404)
+        if job["failed"]:
+            self.stats["failed"] += 1
+            return web.Response(status=500, text="Internal Server Error")
+        self.stats["completed"] += 1
+        url = f"{request.scheme}://{request.host}/cdn/{request_id}.png"
+        return web.json_response({"images": [{"url": url, "content_type": "image/png"}]})
+
+    async def cdn(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.image, content_type="image/png")
+
+
+class FakeTelegram:
+    """Минимальный Bot API: ровно те методы, которые вызывает main.py."""
+
+    def __init__(self, latency: float = 0.03, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats: dict[str, int] = {}
+        self.photos: dict[str, bytes] = {}
+        self._message_id = 0
+
+    def add_routes(self, app: web.Application):
+        # Регистрируется раньше FakeFal: /bot<token>/<method> подходит и под /{owner}/{model}
+        app.router.add_post("/bot{token}/{method}", self.method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        message.update(extra)
+        return message
+
+    def _photo(self) -> list[dict]:
+        file_id = f"photo-{self._message_id + 1}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}]
+
+    async def method(self, request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        self.stats[name] = self.stats.get(name, 0) + 1
+        params = dict(await request.post())
+        # Сколько байт бот загрузил в Bot API — фото файлами, а не ссылками
+        for value in params.values():
+            if isinstance(value, web.FileField):
+                self.stats["upload_bytes"] = self.stats.get("upload_bytes", 0) + value.file.seek(0, 2)
+        await asyncio.sleep(random.uniform(0, 2 * self.latency))
+        if name not in ("getMe", "getFile") and random.random() < self.error_rate:
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                 "parameters": {"retry_after": 1}},
+                status=429,
+            )
+
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif name == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_path": f"photos/{file_id}.jpg"}
+        elif name in ("sendPhoto",):
+            result = self._message(chat_id, photo=self._photo())
+        elif name == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            result = [self._message(chat_id, photo=self._photo()) for _ in media]
+        elif name in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif name == "copyMessage":
+            result = {"message_id": self._message(chat_id)["message_id"]}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def file(self, request: web.Request) -> web.Response:
+        path = request.match_info["path"]
+        photo = self.photos.get(path)
+        if photo is None:
+            photo = self.photos[path] = make_jpeg(seed=zlib.crc32(path.encode()))
+        return web.Response(body=photo, content_type="image/jpeg")
+
+
+class FakeOpenAI:
+    """chat.completions (перевод) и images.generations (gpt-image-1)."""
+
+    def __init__(self, chat_latency: float = 0.5, image_latency: float = 5.0, error_rate: float = 0.0):
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.error_rate = error_rate
+        self.stats = {"chat": 0, "images": 0, "failed": 0}
+        self.image_b64 = base64.b64encode(make_png()).decode("ascii")
+
+    def add_routes(self, app: web.Application):
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/images/generations", self.images)
+
+    def _error(self) -> web.Response:
+        self.stats["failed"] += 1
+        return web.json_response(
+            {"error": {"message": "The server had an error", "type": "server_error"}}, status=500
+        )
+
+    async def chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats["chat"] += 1
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.chat_latency)
+        if random.random() < self.error_rate:
+            return self._error()
+        prompt = body["messages"][-1]["content"]
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"translated: {prompt}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        })
+
+    async def images(self, request: web.Request) -> web.Response:
+        await request.json()
+        self.stats["images"] += 1
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.image_latency)
+        if random.random() < self.error_rate:
+            return self._error()
+        return web.json_response({"created": int(time.time()), "data": [{"b64_json": self.image_b64}]})
+
+
+def make_app(*fakes) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({type(fake).__name__: fake.stats for fake in fakes})
+
+    app.router.add_get("/_stats", stats)
+    for fake in fakes:
+        fake.add_routes(app)
+    return app
+
+
+async def serve(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--fal-latency", type=float, default=2.0)
+    parser.add_argument("--fal-jitter", type=float, default=0.5)
+    parser.add_argument("--openai-latency", type=float, default=5.0)
+    parser.add_argument("--translate-latency", type=float, default=0.5)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+
+
+def run_server(args: argparse.Namespace, host: str, port: int):
+    app = make_app(
+        FakeTelegram(args.telegram_latency, args.telegram_error_rate),
+        FakeOpenAI(args.translate_latency, args.openai_latency, args.error_rate),
+        FakeFal(args.fal_latency, args.fal_jitter, args.error_rate),
+    )
+    web.run_app(app, host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    run_server(args, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Офлайн-нагрузка на настоящие хендлеры main.py через dp.feed_update.
+
+Bot API, fal.ai и OpenAI заменяются заглушками из bench/fakes.py (в отдельном
+процессе, чтобы не мешать замеру CPU и памяти бота), база — временный
+Postgres. Сеть не нужна:
+
+    python -m bench.loadtest --users 200 --concurrency 50
+
+Каждый синтетический пользователь проходит сценарий: фото → открытка к 8 марта
+→ /balance → текстовый промпт → /start. С --spammers параллельно работают
+пользователи, которые шлют пачки промптов без пауз: p99 обычных не должен
+заметно расти. Если указан --database-url, используется
+он (таблицы бота будут созданы в этой базе), иначе запускается временный
+кластер через initdb/pg_ctl из PATH или пакет pgserver.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from bench import fakes
+
+SCENARIO = ["photo", "template", "balance", "text", "start"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def temp_postgres():
+    with tempfile.TemporaryDirectory(prefix="bench-pg-") as data_dir:
+        if shutil.which("initdb") and shutil.which("pg_ctl"):
+            subprocess.run(["initdb", "-D", data_dir, "-U", "postgres", "-A", "trust"],
+                           check=True, stdout=subprocess.DEVNULL)
+            subprocess.run(["pg_ctl", "-D", data_dir, "-w", "-l", os.path.join(data_dir, "log"),
+                            "-o", f"-k {data_dir} -c listen_addresses=''", "start"],
+                           check=True, stdout=subprocess.DEVNULL)
+            try:
+                yield f"postgresql://postgres@/postgres?host={data_dir}"
+            finally:
+                subprocess.run(["pg_ctl", "-D", data_dir, "-m", "fast", "stop"],
+                               stdout=subprocess.DEVNULL)
+            return
+        try:
+            import pgserver
+        except ImportError:
+            raise SystemExit("Нужен --database-url, initdb/pg_ctl в PATH или pip install pgserver")
+        server = pgserver.get_server(data_dir, cleanup_mode="stop")
+        try:
+            yield server.get_uri()
+        finally:
+            server.cleanup()
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}"}
+
+
+def make_update(update_id: int, user_id: int, kind: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": make_user(user_id),
+    }
+    if kind == "photo":
+        message["photo"] = [{"file_id": f"upload-{user_id}", "file_unique_id": f"u{user_id}",
+                             "width": 1280, "height": 960}]
+    elif kind == "template":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": make_user(user_id), "chat_instance": str(user_id),
+            "message": {**message, "text": "🌷 Выбери стиль открытки к 8 марта:"},
+            "data": "m8_m8_tulips",
+        }}
+    elif kind == "text":
+        message["text"] = "девушка с букетом тюльпанов на фоне весеннего города"
+    else:
+        message["text"] = f"/{kind}"
+    return {"update_id": update_id, "message": message}
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+async def run(args, fakes_url: str, database_url: str):
+    os.environ.update({
+        "BOT_TOKEN": "123456:LOADTEST",
+        "OPENAI_API_KEY": "loadtest",
+        "OPENAI_BASE_URL": f"{fakes_url}/v1",
+        "FAL_API_KEY": "loadtest",
+        "FAL_QUEUE_URL": fakes_url,
+        "TELEGRAM_API_URL": fakes_url,
+        "DATABASE_PUBLIC_URL": database_url,
+    })
+    import main
+    from aiogram.types import Update
+
+    logging.getLogger().setLevel(logging.WARNING if not args.verbose else logging.INFO)
+
+    await main.start_services()
+    for user_id in range(1, args.users + args.spammers + 1):
+        await main.add_credits(user_id, 100, reason="loadtest")
+
+    latencies: dict[str, list[float]] = {kind: [] for kind in SCENARIO}
+    errors: dict[str, int] = {kind: 0 for kind in SCENARIO}
+    update_ids = iter(range(1, 10 ** 9))
+    users = iter(range(1, args.users + 1))
+
+    async def user_worker():
+        for user_id in users:
+            for kind in SCENARIO:
+                update = Update.model_validate(make_update(next(update_ids), user_id, kind))
+                started = time.perf_counter()
+                try:
+                    await main.dp.feed_update(main.bot, update)
+                except Exception:
+                    errors[kind] += 1
+                latencies[kind].append(time.perf_counter() - started)
+
+    spam_latencies: list[float] = []
+
+    async def spammer(user_id: int):
+        async def send():
+            update = Update.model_validate(make_update(next(update_ids), user_id, "text"))
+            started = time.perf_counter()
+            try:
+                await main.dp.feed_update(main.bot, update)
+            except Exception:
+                pass
+            spam_latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*[send() for _ in range(args.spam_messages)])
+
+    spammers = range(args.users + 1, args.users + args.spammers + 1)
+    started = time.perf_counter()
+    await asyncio.gather(
+        *[user_worker() for _ in range(args.concurrency)],
+        *[spammer(user_id) for user_id in spammers],
+    )
+    elapsed = time.perf_counter() - started
+    await main.stop_services()
+    await main.bot.session.close()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    print(f"Апдейтов: {len(all_latencies)} за {elapsed:.1f} с — {len(all_latencies) / elapsed:.1f} апдейтов/с")
+    print(f"{'тип':>10} {'n':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'ошибки':>7}")
+    for kind, values in [*latencies.items(), ("всего", all_latencies)]:
+        errors_count = errors.get(kind, sum(errors.values()))
+        print(f"{kind:>10} {len(values):>6} {percentile(values, 50) * 1000:>9.0f} "
+              f"{percentile(values, 95) * 1000:>9.0f} {percentile(values, 99) * 1000:>9.0f} {errors_count:>7}")
+    if args.spammers:
+        print(f"{'спам':>10} {len(spam_latencies):>6} {percentile(spam_latencies, 50) * 1000:>9.0f} "
+              f"{percentile(spam_latencies, 95) * 1000:>9.0f} {percentile(spam_latencies, 99) * 1000:>9.0f}")
+        print(f"Отброшено до хендлеров: {dict(main.THROTTLED_UPDATES._values)}")
+    print(f"Пиковый RSS бота: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} МБ")
+    with urllib.request.urlopen(f"{fakes_url}/_stats") as response:
+        print(f"Заглушки: {response.read().decode()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--spammers", type=int, default=0)
+    parser.add_argument("--spam-messages", type=int, default=30)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--verbose", action="store_true")
+    fakes.add_arguments(parser)
+    args = parser.parse_args()
+
+    port = free_port()
+    fakes_url = f"http://127.0.0.1:{port}"
+    server = multiprocessing.get_context("spawn").Process(
+        target=fakes.run_server, args=(args, "127.0.0.1", port), daemon=True
+    )
+    server.start()
+    try:
+        for _ in range(100):
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    break
+            except OSError:
+                time.sleep(0.1)
+        if args.database_url:
+            asyncio.run(run(args, fakes_url, args.database_url))
+        else:
+            with temp_postgres() as database_url:
+                asyncio.run(run(args, fakes_url, database_url))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Нагрузочный прогон webhook-режима: сколько апдейтов в секунду успевают обработать воркеры.
+
+Сначала запустить этот скрипт (он же поднимает заглушку Bot API):
+
+    python -m bench.webhook_load --updates 5000 --concurrency 64
+
+затем в другом терминале бота, указав на заглушку и дождавшись готовности
+порта (скрипт ждёт его сам):
+
+    BOT_MODE=webhook WEB_WORKERS=4 WEBHOOK_BACKGROUND=0 \\
+    TELEGRAM_API_URL=http://127.0.0.1:8082 python main.py
+
+WEBHOOK_BACKGROUND=0 заставляет сервер отвечать только после обработки
+апдейта, поэтому замер показывает работу хендлеров, а не приём HTTP.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import aiohttp
+
+from bench.fakes import FakeTelegram, make_app, serve
+
+COMMANDS = ["/balance", "/start", "/buy", "/balance", "/march8"]
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": text,
+        },
+    }
+
+
+async def wait_for_port(url: str, session: aiohttp.ClientSession):
+    while True:
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                return
+        except aiohttp.ClientConnectionError:
+            await asyncio.sleep(0.5)
+
+
+async def run(args):
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    await serve(make_app(telegram), "127.0.0.1", args.telegram_port)
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(args.updates))
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        print(f"Жду бота на {args.url} ...")
+        await wait_for_port(args.url, session)
+
+        async def worker():
+            nonlocal errors
+            for update_id in counter:
+                user_id = random.randint(1, args.users)
+                update = make_update(update_id, user_id, random.choice(COMMANDS))
+                started = time.perf_counter()
+                try:
+                    async with session.post(args.url, json=update) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"Апдейтов: {len(latencies)} за {elapsed:.1f} с, ошибок: {errors}")
+    print(f"Пропускная способность: {len(latencies) / elapsed:.0f} апдейтов/с")
+    print(f"Задержка p50 {quantiles[49] * 1000:.0f} мс, p95 {quantiles[94] * 1000:.0f} мс, "
+          f"p99 {quantiles[98] * 1000:.0f} мс")
+    print(f"Вызовы Bot API: {telegram.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--telegram-port", type=int, default=8082)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,34 @@
 import asyncio
+import contextvars
+import hashlib
+import importlib.util
 import os
 import base64
+import json
 import logging
+import multiprocessing
+import random
+import re
+import time
 import httpx
 import asyncpg
+from collections import OrderedDict, deque
+from dataclasses import astuple, dataclass, fields
+from typing import Any, Awaitable, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
-from openai import OpenAI
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,8 +41,144 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 FAL_API_KEY = os.getenv("FAL_API_KEY")
 PAYMENT_PHONE = os.getenv("PAYMENT_PHONE")
 DATABASE_URL = os.getenv("DATABASE_PUBLIC_URL")
+# Столько соединений пул открывает сразу при старте, остальные — по мере нагрузки
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "4"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
 ADMIN_ID = 1991186266
 
+# polling — один процесс; webhook — aiohttp-сервер, который можно запускать в WEB_WORKERS процессах
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres" if BOT_MODE == "webhook" else "memory")
+# Сколько секунд воркер верит своей копии FSM-состояния; 0 — читать из БД на каждый апдейт
+FSM_STATE_CACHE_TTL = float(os.getenv("FSM_STATE_CACHE_TTL", "2"))
+FSM_STORAGE_TTL_DAYS = int(os.getenv("FSM_STORAGE_TTL_DAYS", "30"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_BACKGROUND = os.getenv("WEBHOOK_BACKGROUND", "1") == "1"
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+# /metrics включается явно, на отдельном порту и по умолчанию только для локальных запросов
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+OPENAI_CHAT_CONCURRENCY = int(os.getenv("OPENAI_CHAT_CONCURRENCY", "8"))
+OPENAI_TRANSLATE_TIMEOUT = float(os.getenv("OPENAI_TRANSLATE_TIMEOUT", "30"))
+OPENAI_IMAGE_TIMEOUT = float(os.getenv("OPENAI_IMAGE_TIMEOUT", "180"))
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "5000"))
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "180"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "90"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+MAX_RESULT_BYTES = int(os.getenv("MAX_RESULT_BYTES", str(25 * 1024 * 1024)))
+# url — отдавать Telegram ссылку fal.ai, он скачает сам; upload — всегда загружать байты
+RESULT_DELIVERY = os.getenv("RESULT_DELIVERY", "url")
+# Результаты крупнее порога перекодируются перед загрузкой (JPEG или WEBP)
+RESULT_REENCODE_BYTES = int(os.getenv("RESULT_REENCODE_BYTES", str(1024 * 1024)))
+RESULT_IMAGE_FORMAT = os.getenv("RESULT_IMAGE_FORMAT", "JPEG").upper()
+RESULT_IMAGE_QUALITY = int(os.getenv("RESULT_IMAGE_QUALITY", "92"))
+
+IMAGE_POOL = os.getenv("IMAGE_POOL", "thread")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+PHOTO_STORE_MAX_BYTES = int(os.getenv("PHOTO_STORE_MAX_BYTES", str(64 * 1024 * 1024)))
+PHOTO_STORE_TTL = int(os.getenv("PHOTO_STORE_TTL", "3600"))
+# Фото могут заменить или сбросить в другом процессе (воркеры webhook, несколько
+# инстансов за балансировщиком): тогда копия в памяти сверяется с file_id в БД
+PHOTO_STORE_SHARED = os.getenv("PHOTO_STORE_SHARED", "1" if FSM_STORAGE == "postgres" else "0") == "1"
+PHOTO_DB_TTL_DAYS = int(os.getenv("PHOTO_DB_TTL_DAYS", "7"))
+
+# Проверка лица на загруженном фото (нужен opencv-python-headless): off, warn или reject
+FACE_CHECK = os.getenv("FACE_CHECK", "warn")
+# Лицо меньше этой доли короткой стороны фото не считается: для fal.ai оно всё равно мало
+FACE_MIN_FRACTION = float(os.getenv("FACE_MIN_FRACTION", "0.1"))
+# Обрезать фото вокруг самого крупного лица; уменьшает запрос к fal.ai,
+# но фигура с фото перестаёт влиять на результат
+FACE_CROP = os.getenv("FACE_CROP", "0") == "1"
+FACE_CROP_MARGIN = float(os.getenv("FACE_CROP_MARGIN", "3"))
+
+FAL_QUEUE_URL = os.getenv("FAL_QUEUE_URL", "https://queue.fal.run")
+FAL_MODEL = os.getenv("FAL_MODEL", "fal-ai/flux-pulid")
+# Общий бюджет времени на генерацию вместе с повторами
+FAL_TIMEOUT = float(os.getenv("FAL_TIMEOUT", "180"))
+FAL_MIN_ATTEMPT_TIMEOUT = float(os.getenv("FAL_MIN_ATTEMPT_TIMEOUT", "60"))
+FAL_RETRIES = int(os.getenv("FAL_RETRIES", "2"))
+FAL_RETRY_BACKOFF = float(os.getenv("FAL_RETRY_BACKOFF", "1"))
+FAL_HEDGE = os.getenv("FAL_HEDGE", "0") == "1"
+FAL_HEDGE_MIN_DELAY = float(os.getenv("FAL_HEDGE_MIN_DELAY", "15"))
+FAL_BREAKER_THRESHOLD = int(os.getenv("FAL_BREAKER_THRESHOLD", "5"))
+FAL_BREAKER_RESET = float(os.getenv("FAL_BREAKER_RESET", "30"))
+# Текстовые промпты с фото при недоступном fal.ai генерируются через gpt-image-1 без сохранения лица
+FAL_FALLBACK_TEXT = os.getenv("FAL_FALLBACK_TEXT", "0") == "1"
+FAL_POLL_INTERVAL = float(os.getenv("FAL_POLL_INTERVAL", "0.5"))
+FAL_POLL_MAX_INTERVAL = float(os.getenv("FAL_POLL_MAX_INTERVAL", "3"))
+
+GEN_FLUX_CONCURRENCY = int(os.getenv("GEN_FLUX_CONCURRENCY", "4"))
+GEN_OPENAI_CONCURRENCY = int(os.getenv("GEN_OPENAI_CONCURRENCY", "4"))
+GEN_QUEUE_MAX = int(os.getenv("GEN_QUEUE_MAX", "100"))
+GEN_QUEUE_STATUS_UPDATES = int(os.getenv("GEN_QUEUE_STATUS_UPDATES", "10"))
+
+# Входящие сообщения и нажатия кнопок: запас и скорость пополнения на пользователя
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "5"))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "50000"))
+
+# Рассылка: общий лимит Bot API около 30 сообщений в секунду, часть оставляем обычным ответам
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "5000"))
+# Списывать ли генерацию, если открытка отдана из кэша или из уже идущего запроса
+RESULT_CACHE_CHARGE = os.getenv("RESULT_CACHE_CHARGE", "1") == "1"
+
+# История генераций пишется в БД пачками раз в HISTORY_FLUSH_INTERVAL секунд
+# В альбоме Telegram не больше 10 фото
+HISTORY_PAGE_SIZE = min(10, max(1, int(os.getenv("HISTORY_PAGE_SIZE", "5"))))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "200"))
+HISTORY_MAX_PENDING = int(os.getenv("HISTORY_MAX_PENDING", "10000"))
+
+# Формат картинки по ключевым словам промпта, правила по убыванию приоритета.
+# IMAGE_SIZE_RULES_FILE может указать JSON со своим списком правил того же вида.
+IMAGE_SIZE_RULES = [
+    {
+        "orientation": "vertical", "fal_size": "portrait_16_9", "openai_size": "1024x1536",
+        "keywords": [
+            "full body", "whole body", "standing", "walking",
+            "в полный рост", "весь рост", "стоит", "стоят", "идёт", "идут",
+        ],
+    },
+    {
+        "orientation": "landscape", "fal_size": "landscape_4_3", "openai_size": "1536x1024",
+        "keywords": [
+            "landscape*", "panorama*", "panoramic", "wide", "city", "cities", "cityscape", "street", "streets",
+            "nature", "ocean*", "beach", "beaches", "forest*", "mountain*", "sky", "skies", "skyline",
+            "пейзаж*", "панорам*", "широкий", "широкоугольн*", "горизонтальн*", "город*", "улиц*",
+            "природ*", "океан*", "море", "моря", "морю", "морем", "морск*", "пляж*",
+            "лес", "леса", "лесу", "лесом", "лесн*", "гора", "горы", "гору", "горах", "горн*",
+            "небо", "неба", "небе", "небом",
+        ],
+    },
+    {
+        "orientation": "portrait", "fal_size": "portrait_4_3", "openai_size": "1024x1536",
+        "keywords": [
+            "portrait*", "close-up", "face", "faces", "headshot*", "selfie*", "profile",
+            "портрет*", "крупный план", "крупным планом", "лицо", "лица", "лицом", "лице",
+            "вертикальн*", "профиль", "профиле",
+        ],
+    },
+]
+DEFAULT_IMAGE_SIZE = {"orientation": "square", "fal_size": "square_hd", "openai_size": "1024x1024"}
+if os.getenv("IMAGE_SIZE_RULES_FILE"):
+    with open(os.getenv("IMAGE_SIZE_RULES_FILE"), encoding="utf-8") as rules_file:
+        IMAGE_SIZE_RULES = json.load(rules_file)
+
 TARIFFS = {
     "1": {"name": "1 фото", "count": 1, "price": 29},
     "10": {"name": "10 фото", "count": 10, "price": 199},
@@ -36,6 +188,9 @@ TARIFFS = {
 
 FREE_CREDITS = 3
 
+KNOWN_USERS_MAX = int(os.getenv("KNOWN_USERS_MAX", "200000"))
+CREDIT_CACHE_TTL = float(os.getenv("CREDIT_CACHE_TTL", "15"))
+
 MARCH8_TEMPLATES = {
     "m8_tulips": {
         "name": "🌷 С букетом тюльпанов",
@@ -55,103 +210,922 @@ MARCH8_TEMPLATES = {
     },
 }
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage: состояние видно любому воркеру.
+
+    get_state aiogram вызывает на каждый апдейт ещё до хендлеров и антифлуда,
+    поэтому состояние кэшируется в процессе на FSM_STATE_CACHE_TTL секунд.
+    Свои изменения воркер видит сразу; изменение, сделанное другим воркером,
+    может быть не видно до истечения TTL. Очищенные записи удаляются из таблицы.
+    """
+
+    def __init__(self, cache_ttl: float = 0, cache_size: int = 50000):
+        self.key_builder = DefaultKeyBuilder(
+            with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # ключ -> (состояние, момент устаревания)
+        self._states: OrderedDict[str, tuple[str | None, float]] = OrderedDict()
+
+    def _remember(self, key: str, state: str | None):
+        if self.cache_ttl <= 0:
+            return
+        self._states[key] = (state, time.monotonic() + self.cache_ttl)
+        self._states.move_to_end(key)
+        while len(self._states) > self.cache_size:
+            self._states.popitem(last=False)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        storage_key = self.key_builder.build(key)
+        async with db_pool.acquire() as conn:
+            if value is None:
+                # Пустая запись не нужна: удаляем её, а если данные ещё есть — только сбрасываем состояние
+                await conn.execute("""
+                    WITH deleted AS (
+                        DELETE FROM fsm_storage WHERE key = $1 AND data = '{}'::jsonb RETURNING 1
+                    )
+                    UPDATE fsm_storage SET state = NULL, updated_at = NOW()
+                    WHERE key = $1 AND NOT EXISTS (SELECT 1 FROM deleted)
+                """, storage_key)
+            else:
+                await conn.execute("""
+                    INSERT INTO fsm_storage (key, state) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET state = $2, updated_at = NOW()
+                """, storage_key, value)
+        self._remember(storage_key, value)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        storage_key = self.key_builder.build(key)
+        cached = self._states.get(storage_key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        async with db_pool.acquire() as conn:
+            state = await conn.fetchval("SELECT state FROM fsm_storage WHERE key = $1", storage_key)
+        self._remember(storage_key, state)
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        async with db_pool.acquire() as conn:
+            if not data:
+                await conn.execute("""
+                    WITH deleted AS (
+                        DELETE FROM fsm_storage WHERE key = $1 AND state IS NULL RETURNING 1
+                    )
+                    UPDATE fsm_storage SET data = '{}'::jsonb, updated_at = NOW()
+                    WHERE key = $1 AND NOT EXISTS (SELECT 1 FROM deleted)
+                """, self.key_builder.build(key))
+                return
+            await conn.execute("""
+                INSERT INTO fsm_storage (key, data) VALUES ($1, $2::jsonb)
+                ON CONFLICT (key) DO UPDATE SET data = $2::jsonb, updated_at = NOW()
+            """, self.key_builder.build(key), json.dumps(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        async with db_pool.acquire() as conn:
+            data = await conn.fetchval(
+                "SELECT data FROM fsm_storage WHERE key = $1", self.key_builder.build(key)
+            )
+        return json.loads(data) if data else {}
+
+    async def prune(self):
+        """Брошенные на середине сценарии (например, чек так и не прислали)."""
+        async with db_pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM fsm_storage WHERE updated_at < NOW() - make_interval(days => $1)", FSM_STORAGE_TTL_DAYS
+            )
+        now = time.monotonic()
+        for key in [key for key, (_, expires_at) in self._states.items() if expires_at <= now]:
+            del self._states[key]
+
+    async def close(self) -> None:
+        pass
+
+
+def create_bot() -> Bot:
+    session = None
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    return Bot(token=BOT_TOKEN, session=session)
+
+
+bot = create_bot()
+storage = PostgresStorage(FSM_STATE_CACHE_TTL) if FSM_STORAGE == "postgres" else MemoryStorage()
 dp = Dispatcher(storage=storage)
-client = OpenAI(api_key=OPENAI_API_KEY)
+# openai импортируется ~0.7 с, поэтому клиент создаётся при первом запросе (см. openai_client)
+client = None
+# Генерации gpt-image-1 ограничивает планировщик, здесь — только перевод
+openai_chat_semaphore = asyncio.Semaphore(OPENAI_CHAT_CONCURRENCY)
 
-user_photos: dict[int, str] = {}
 db_pool = None
+http_client: httpx.AsyncClient | None = None
+image_executor: Executor | None = None
 
+CYRILLIC_RE = re.compile(r"[а-яё]", re.IGNORECASE)
+translation_cache: OrderedDict[str, str] = OrderedDict()
+translation_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "skipped": 0}
 
-async def init_db():
-    global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
-    async with db_pool.acquire() as conn:
+# Пользователи, которые точно есть в таблице users: init_user не ходит для них в БД
+known_users: OrderedDict[int, None] = OrderedDict()
+# user_id -> (credits, момент устаревания); все изменения кредитов пишут сюда же
+credit_cache: dict[int, tuple[int, float]] = {}
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение снимается функцией в момент запроса /metrics."""
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], dict[tuple[str, ...], float]],
+                 labelnames: tuple[str, ...] = (), metric_type: str = "gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.labelnames = labelnames
+        self.metric_type = metric_type
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        try:
+            values = self.read()
+        except Exception:
+            values = {}
+        for key, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...],
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счётчики по бакетам..., сумма, количество]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+# provider и kind текущей генерации; планировщик переносит их в задачу воркера
+generation_labels: contextvars.ContextVar[dict[str, str]] = contextvars.ContextVar(
+    "generation_labels", default={}
+)
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_duration_seconds", "Длительность отдельных этапов обработки",
+    ("stage", "provider", "kind", "outcome"),
+)
+GENERATION_SECONDS = Histogram(
+    "bot_generation_duration_seconds", "Полное время генерации от запроса до отправки фото",
+    ("provider", "kind", "outcome"),
+)
+metrics_registry: list[Counter | Gauge | Histogram] = [STAGE_SECONDS, GENERATION_SECONDS]
+
+
+class track_stage:
+    """Замер этапа: with track_stage("tg_download"): ..."""
+
+    def __init__(self, stage: str, **labels: str):
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = {**generation_labels.get(), **self.labels}
+        STAGE_SECONDS.observe(
+            time.perf_counter() - self.started,
+            stage=self.stage,
+            provider=labels.get("provider", "none"),
+            kind=labels.get("kind", "none"),
+            outcome="ok" if exc_type is None else "error",
+        )
+        return False
+
+
+# Шаг запуска -> секунды; пишется в лог и отдаётся в /metrics
+startup_seconds: dict[str, float] = {}
+metrics_registry.append(Gauge(
+    "bot_startup_seconds", "Длительность шагов запуска процесса",
+    lambda: {(step,): seconds for step, seconds in startup_seconds.items()}, ("step",),
+))
+
+
+class startup_step:
+    """Замер шага запуска: with startup_step("pool"): ..."""
+
+    def __init__(self, step: str):
+        self.step = step
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        startup_seconds[self.step] = time.perf_counter() - self.started
+        return False
+
+
+def metrics_text() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics_text(), content_type="text/plain", charset="utf-8")
+
+
+def create_http_client() -> httpx.AsyncClient:
+    http2 = HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+    if HTTP2_ENABLED and not http2:
+        logger.warning("Пакет h2 не установлен — HTTP/2 отключён (pip install httpx[http2])")
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+async def download_result(url: str) -> bytes:
+    buffer = bytearray()
+    async with http_client.stream("GET", url) as response:
+        response.raise_for_status()
+        length = response.headers.get("content-length")
+        if length and int(length) > MAX_RESULT_BYTES:
+            raise ValueError(f"Результат слишком большой: {length} байт")
+        async for chunk in response.aiter_bytes():
+            buffer.extend(chunk)
+            if len(buffer) > MAX_RESULT_BYTES:
+                raise ValueError(f"Результат больше {MAX_RESULT_BYTES} байт")
+    return bytes(buffer)
+
+
+# Версии схемы по порядку: применённые не меняются, новые дописываются в конец
+MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "initial", """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            credits INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS translations (
+            prompt_key TEXT PRIMARY KEY,
+            translated TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS reference_photos (
+            user_id BIGINT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            image BYTEA,
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+        ALTER TABLE reference_photos ADD COLUMN IF NOT EXISTS faces INTEGER;
+        CREATE TABLE IF NOT EXISTS credit_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            delta INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at TIMESTAMP DEFAULT NOW(),
+            finished_at TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            sent_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (broadcast_id, user_id)
+        );
+    """),
+    (2, "indexes", """
+        -- warm_known_users: последние KNOWN_USERS_MAX пользователей без сортировки всей таблицы
+        CREATE INDEX IF NOT EXISTS users_created_at_idx ON users (created_at DESC);
+        -- История начислений и списаний одного пользователя
+        CREATE INDEX IF NOT EXISTS credit_ledger_user_idx ON credit_ledger (user_id, created_at);
+        -- Уборщик фото: в индексе только строки, у которых ещё хранятся байты
+        CREATE INDEX IF NOT EXISTS reference_photos_expiry_idx ON reference_photos (updated_at)
+            WHERE image IS NOT NULL;
+    """),
+    (3, "generations", """
+        CREATE TABLE IF NOT EXISTS generations (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            prompt TEXT NOT NULL,
+            translated_prompt TEXT,
+            template_key TEXT,
+            image_size TEXT,
+            provider TEXT NOT NULL,
+            latency_ms INTEGER,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        -- /history: страницы одного пользователя от новых к старым
+        CREATE INDEX IF NOT EXISTS generations_user_idx ON generations (user_id, id DESC);
+    """),
+]
+
+
+async def migrate(conn: asyncpg.Connection) -> int:
+    """Применяет недостающие миграции и возвращает их число."""
+    latest = MIGRATIONS[-1][0]
+    try:
+        # Обычный перезапуск: схема актуальна, один запрос вместо всех CREATE ... IF NOT EXISTS
+        if await conn.fetchval("SELECT max(version) FROM schema_migrations") == latest:
+            return 0
+    except asyncpg.UndefinedTableError:
+        pass
+    async with conn.transaction():
+        # Воркеры webhook стартуют одновременно: миграции применяет первый, остальные ждут его
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'), 0)")
         await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                credits INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT NOW()
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
             )
         """)
-    logger.info("База данных инициализирована!")
+        applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+        for version, name, sql in pending:
+            await conn.execute(sql)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+            )
+            logger.info(f"Миграция {version} ({name}) применена")
+    return len(pending)
+
+
+# Запросы к балансу идут почти на каждое сообщение: тексты неизменны, и asyncpg
+# переиспользует их план из кэша соединения
+CREDIT_QUERIES = {
+    "get_credits": "SELECT credits FROM users WHERE user_id = $1",
+    "init_user": """
+        INSERT INTO users (user_id, credits) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING credits
+    """,
+    "add_credits": """
+        WITH updated AS (
+            INSERT INTO users (user_id, credits) VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE SET credits = users.credits + $2
+            RETURNING credits
+        ), logged AS (
+            INSERT INTO credit_ledger (user_id, delta, reason)
+            SELECT $1, $2, $3 FROM updated
+        )
+        SELECT credits FROM updated
+    """,
+    "reserve_credits": """
+        WITH reserved AS (
+            UPDATE users SET credits = credits - $2
+            WHERE user_id = $1 AND credits >= $2
+            RETURNING credits
+        ), logged AS (
+            INSERT INTO credit_ledger (user_id, delta, reason)
+            SELECT $1, -$2, $3 FROM reserved
+        )
+        SELECT credits FROM reserved
+    """,
+    "refund_credits": """
+        WITH refunded AS (
+            UPDATE users SET credits = credits + $2
+            WHERE user_id = $1
+            RETURNING credits
+        ), logged AS (
+            INSERT INTO credit_ledger (user_id, delta, reason)
+            SELECT $1, $2, $3 FROM refunded
+        )
+        SELECT credits FROM refunded
+    """,
+}
+
+
+async def init_db():
+    global db_pool
+    # Миграции идут до пула: воркеры не должны работать со схемой, которая ещё меняется
+    with startup_step("migrations"):
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            applied = await migrate(conn)
+        finally:
+            await conn.close()
+    with startup_step("db_pool"):
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+        )
+    logger.info(f"База данных инициализирована, новых миграций: {applied}")
+
+
+def mark_known_user(user_id: int):
+    known_users[user_id] = None
+    known_users.move_to_end(user_id)
+    while len(known_users) > KNOWN_USERS_MAX:
+        known_users.popitem(last=False)
+
+
+def cache_credits(user_id: int, credits: int | None):
+    if credits is None:
+        credit_cache.pop(user_id, None)
+    else:
+        credit_cache[user_id] = (credits, time.monotonic() + CREDIT_CACHE_TTL)
+
+
+async def warm_known_users():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT user_id FROM users ORDER BY created_at DESC LIMIT $1", KNOWN_USERS_MAX
+        )
+    for row in reversed(rows):
+        mark_known_user(row["user_id"])
+    logger.info(f"Известных пользователей загружено: {len(known_users)}")
 
 
 async def get_credits(user_id: int) -> int:
+    cached = credit_cache.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT credits FROM users WHERE user_id = $1", user_id)
+        row = await conn.fetchrow(CREDIT_QUERIES["get_credits"], user_id)
         if row is None:
             return -1
+        cache_credits(user_id, row["credits"])
         return row["credits"]
 
 
 async def init_user(user_id: int) -> bool:
+    if user_id in known_users:
+        known_users.move_to_end(user_id)
+        return False
     async with db_pool.acquire() as conn:
-        existing = await conn.fetchrow("SELECT user_id FROM users WHERE user_id = $1", user_id)
-        if existing is None:
-            await conn.execute(
-                "INSERT INTO users (user_id, credits) VALUES ($1, $2)",
-                user_id, FREE_CREDITS
-            )
-            return True
+        credits = await conn.fetchval(CREDIT_QUERIES["init_user"], user_id, FREE_CREDITS)
+    mark_known_user(user_id)
+    if credits is None:
         return False
+    cache_credits(user_id, credits)
+    return True
 
 
-async def add_credits(user_id: int, count: int):
+async def add_credits(user_id: int, count: int, reason: str = "purchase") -> int:
     async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (user_id, credits) VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET credits = users.credits + $2
-        """, user_id, count)
+        credits = await conn.fetchval(CREDIT_QUERIES["add_credits"], user_id, count, reason)
+    mark_known_user(user_id)
+    cache_credits(user_id, credits)
+    return credits
+
 
+class CreditReservation:
+    """Списанные заранее генерации: либо подтверждаются, либо возвращаются."""
+
+    def __init__(self, user_id: int, count: int, remaining: int):
+        self.user_id = user_id
+        self.count = count
+        self.remaining = remaining
+        self.settled = False
+
+    def commit(self):
+        self.settled = True
+
+    async def refund(self, count: int | None = None, reason: str = "refund"):
+        if self.settled:
+            return
+        count = self.count if count is None else count
+        self.settled = True
+        if count <= 0:
+            return
+        async with db_pool.acquire() as conn:
+            self.remaining = await conn.fetchval(
+                CREDIT_QUERIES["refund_credits"], self.user_id, count, reason
+            )
+        cache_credits(self.user_id, self.remaining)
 
-async def use_credit(user_id: int) -> bool:
+
+async def reserve_credits(user_id: int, count: int = 1, reason: str = "generation") -> CreditReservation | None:
+    # Проверка и списание одним UPDATE ... RETURNING: два параллельных запроса
+    # не могут оба увидеть credits=1 и потратить один кредит
     async with db_pool.acquire() as conn:
-        result = await conn.execute("""
-            UPDATE users SET credits = credits - 1
-            WHERE user_id = $1 AND credits > 0
-        """, user_id)
-        return result == "UPDATE 1"
+        remaining = await conn.fetchval(CREDIT_QUERIES["reserve_credits"], user_id, count, reason)
+    cache_credits(user_id, remaining)
+    if remaining is None:
+        return None
+    return CreditReservation(user_id, count, remaining)
+
+
+def create_image_executor() -> Executor:
+    if IMAGE_POOL == "process":
+        return ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
 
 
-def compress_image(image_bytes: bytes, max_size: int = 1024) -> str:
+def preprocess_image(image_bytes: bytes, max_size: int = 1024) -> bytes:
+    from PIL import Image, ImageOps
+
     img = Image.open(BytesIO(image_bytes))
+    if img.format == "JPEG":
+        # Декодер JPEG сразу уменьшает в 2/4/8 раз — 12 Мп фото не разворачивается целиком
+        img.draft("RGB", (max_size, max_size))
+    img = ImageOps.exif_transpose(img)
     if img.mode != "RGB":
         img = img.convert("RGB")
     img.thumbnail((max_size, max_size), Image.LANCZOS)
     buffer = BytesIO()
     img.save(buffer, format="JPEG", quality=85)
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return buffer.getvalue()
+
+
+def encode_result(image_bytes: bytes) -> bytes:
+    """PNG от генераторов весит в разы больше JPEG того же качества, а Telegram всё равно пережимает фото."""
+    from PIL import Image
+
+    img = Image.open(BytesIO(image_bytes))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    buffer = BytesIO()
+    img.save(buffer, format=RESULT_IMAGE_FORMAT, quality=RESULT_IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+face_cascade = None
+
+
+def detect_faces(image_bytes: bytes, max_side: int = 384) -> list[tuple[int, int, int, int]]:
+    """Лица (x, y, w, h) в координатах исходной картинки, самое крупное первым."""
+    global face_cascade
+    import cv2
+    import numpy as np
+
+    if face_cascade is None:
+        cv2.setNumThreads(1)
+        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return []
+    scale = min(1.0, max_side / max(gray.shape))
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Уменьшенная копия и крупный шаг масштаба: ~70 мс на 1 ядре вместо ~300
+    min_size = max(16, int(min(gray.shape) * FACE_MIN_FRACTION))
+    found = face_cascade.detectMultiScale(gray, scaleFactor=1.15, minNeighbors=5, minSize=(min_size, min_size))
+    faces = [tuple(int(v / scale) for v in face) for face in found]
+    return sorted(faces, key=lambda f: f[2] * f[3], reverse=True)
+
+
+def check_face(image_bytes: bytes) -> tuple[bytes, int]:
+    """Считает лица на подготовленном фото и, если включено, обрезает его вокруг самого крупного."""
+    faces = detect_faces(image_bytes)
+    if not faces or not FACE_CROP:
+        return image_bytes, len(faces)
+    from PIL import Image
+
+    img = Image.open(BytesIO(image_bytes))
+    x, y, w, h = faces[0]
+    side = int(max(w, h) * FACE_CROP_MARGIN)
+    cx, cy = x + w // 2, y + h // 2
+    box = (max(0, cx - side // 2), max(0, cy - side // 2),
+           min(img.width, cx + side // 2), min(img.height, cy + side // 2))
+    if (box[2] - box[0]) * (box[3] - box[1]) > 0.6 * img.width * img.height:
+        return image_bytes, len(faces)
+    buffer = BytesIO()
+    img.crop(box).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue(), len(faces)
+
+
+def face_check_enabled() -> bool:
+    global FACE_CHECK
+    if FACE_CHECK == "off":
+        return False
+    try:
+        import cv2
+        # В OpenCV 5 каскады Хаара вынесены из основного пакета
+        cv2.CascadeClassifier
+    except (ImportError, AttributeError):
+        logger.warning("Нужен opencv-python-headless<5 (pip install 'opencv-python-headless<5') — проверка лица отключена")
+        FACE_CHECK = "off"
+        return False
+    return True
+
+
+async def prepare_reference_photo(image_bytes: bytes) -> tuple[bytes, int | None]:
+    """Предобработка загруженного фото и число лиц на нём (None — проверка выключена)."""
+    loop = asyncio.get_running_loop()
+    with track_stage("preprocess", kind="upload"):
+        reference_image = await loop.run_in_executor(image_executor, preprocess_image, image_bytes)
+    if not face_check_enabled():
+        return reference_image, None
+    with track_stage("face_check", kind="upload"):
+        return await loop.run_in_executor(image_executor, check_face, reference_image)
+
+
+async def download_reference_photo(file_id: str) -> bytes:
+    file = await bot.get_file(file_id)
+    downloaded = await bot.download_file(file.file_path)
+    reference_image, _ = await prepare_reference_photo(downloaded.read())
+    return reference_image
+
+
+@dataclass
+class StoredPhoto:
+    data: bytes
+    file_id: str
+    stored_at: float
+    faces: int | None = None
+
+
+FACE_CHECKS = Counter("bot_face_checks_total", "Проверки лица на загруженных фото", ("verdict",))
+metrics_registry.append(FACE_CHECKS)
+
+
+class PhotoStore:
+    """Референсные фото пользователей: сырые JPEG-байты, а не base64.
+
+    В памяти держится LRU с бюджетом по байтам и TTL, источник истины —
+    таблица reference_photos. Старые байты из неё периодически вычищаются,
+    но file_id остаётся, и фото можно заново скачать из Telegram.
+    """
+
+    def __init__(self, max_bytes: int, ttl: int, shared: bool = False):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Фото могли заменить или сбросить в другом процессе,
+        # поэтому запись в памяти используется только если совпадает file_id в БД
+        self.shared = shared
+        self.bytes_held = 0
+        self._entries: OrderedDict[int, StoredPhoto] = OrderedDict()
+
+    def _remember(self, user_id: int, entry: StoredPhoto):
+        self._forget(user_id)
+        self._entries[user_id] = entry
+        self.bytes_held += len(entry.data)
+        while self.bytes_held > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes_held -= len(evicted.data)
+
+    def _forget(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.bytes_held -= len(entry.data)
+
+    def _cached(self, user_id: int) -> StoredPhoto | None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.stored_at > self.ttl:
+            self._forget(user_id)
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    async def put(self, user_id: int, data: bytes, file_id: str, faces: int | None = None):
+        self._remember(user_id, StoredPhoto(data, file_id, time.monotonic(), faces))
+        async with db_pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO reference_photos (user_id, file_id, image, faces, updated_at)
+                VALUES ($1, $2, $3, $4, NOW())
+                ON CONFLICT (user_id) DO UPDATE
+                SET file_id = $2, image = $3, faces = $4, updated_at = NOW()
+            """, user_id, file_id, data, faces)
+
+    async def get(self, user_id: int) -> bytes | None:
+        entry = self._cached(user_id)
+        if entry is not None and not self.shared:
+            return entry.data
+
+        async with db_pool.acquire() as conn:
+            if entry is not None:
+                file_id = await conn.fetchval(
+                    "SELECT file_id FROM reference_photos WHERE user_id = $1", user_id
+                )
+                if file_id == entry.file_id:
+                    return entry.data
+            row = await conn.fetchrow(
+                "SELECT file_id, image, faces FROM reference_photos WHERE user_id = $1", user_id
+            )
+        if row is None:
+            self._forget(user_id)
+            return None
+
+        data = row["image"]
+        if data is None:
+            logger.info(f"[{user_id}] Фото вытеснено, скачиваю заново по file_id")
+            data = await download_reference_photo(row["file_id"])
+            async with db_pool.acquire() as conn:
+                await conn.execute("""
+                    UPDATE reference_photos SET image = $3, updated_at = NOW()
+                    WHERE user_id = $1 AND file_id = $2
+                """, user_id, row["file_id"], data)
+        self._remember(user_id, StoredPhoto(data, row["file_id"], time.monotonic(), row["faces"]))
+        return data
+
+    async def has(self, user_id: int) -> bool:
+        if not self.shared and self._cached(user_id) is not None:
+            return True
+        async with db_pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT 1 FROM reference_photos WHERE user_id = $1", user_id
+            )
+        return row is not None
+
+    async def faces(self, user_id: int) -> int | None:
+        """Сохранённый при загрузке результат проверки лица."""
+        entry = self._cached(user_id)
+        if entry is not None and not self.shared:
+            return entry.faces
+        async with db_pool.acquire() as conn:
+            return await conn.fetchval("SELECT faces FROM reference_photos WHERE user_id = $1", user_id)
+
+    async def discard(self, user_id: int):
+        self._forget(user_id)
+        async with db_pool.acquire() as conn:
+            await conn.execute("DELETE FROM reference_photos WHERE user_id = $1", user_id)
+
+    async def prune(self):
+        now = time.monotonic()
+        for user_id in [u for u, e in self._entries.items() if now - e.stored_at > self.ttl]:
+            self._forget(user_id)
+        async with db_pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE reference_photos SET image = NULL
+                WHERE image IS NOT NULL AND updated_at < NOW() - make_interval(days => $1)
+            """, PHOTO_DB_TTL_DAYS)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.bytes_held}
+
+
+photo_store = PhotoStore(PHOTO_STORE_MAX_BYTES, PHOTO_STORE_TTL, shared=PHOTO_STORE_SHARED)
+
+
+async def photo_store_janitor():
+    while True:
+        await asyncio.sleep(600)
+        try:
+            await photo_store.prune()
+            if isinstance(storage, PostgresStorage):
+                await storage.prune()
+            stats = photo_store.stats()
+            logger.info(f"Фото в памяти: {stats['entries']} шт., {stats['bytes'] / 1024 / 1024:.1f} МБ")
+        except Exception as e:
+            logger.warning(f"Очистка фото не удалась: {e}")
+
+
+@dataclass
+class SizeMatch:
+    orientation: str
+    fal_size: str
+    openai_size: str
+    keyword: str | None = None
+
+
+class PromptClassifier:
+    """Формат картинки по ключевым словам промпта за один проход регулярки.
+
+    Ключевые слова совпадают только целыми словами: «wide» не находится в
+    «widely», «лес» — в «лестнице». Звёздочка на конце разрешает любое
+    окончание («город*» — «городе», «городской»), пробел или дефис внутри —
+    любой из них или слитное написание, «е» совпадает и с «ё». Все слова
+    собираются в одно префиксное дерево, так что сотни слов почти не
+    замедляют поиск; каждое слово заканчивается пустой группой, по номеру
+    которой видно правило. Если совпало несколько правил, выигрывает стоящее
+    в списке раньше.
+    """
+
+    SEPARATOR = object()
+
+    def __init__(self, rules: list[dict], default: dict):
+        self.rules = rules
+        self.default = SizeMatch(default["orientation"], default["fal_size"], default["openai_size"])
+        trie: dict = {}
+        for index, rule in enumerate(rules):
+            for keyword in rule["keywords"]:
+                node = trie
+                for token in self._tokens(keyword.rstrip("*")):
+                    node = node.setdefault(token, {})
+                # Одинаковое слово в двух правилах достаётся более приоритетному
+                node.setdefault("*" if keyword.endswith("*") else "", index)
+        self._group_rules: list[int] = []
+        self.pattern = re.compile("(?<!\\w)" + self._node_pattern(trie))
+
+    @classmethod
+    def _tokens(cls, keyword: str) -> list:
+        tokens = []
+        for char in keyword.lower():
+            if char in " -":
+                if tokens and tokens[-1] is not cls.SEPARATOR:
+                    tokens.append(cls.SEPARATOR)
+            else:
+                tokens.append("е" if char == "ё" else char)
+        return tokens
+
+    def _node_pattern(self, node: dict) -> str:
+        branches = []
+        # Продолжения раньше окончаний: из «город*» и «городовой» выигрывает более длинное
+        for token, child in sorted(node.items(), key=lambda item: item[0] in ("", "*")):
+            if token == "*" or token == "":
+                self._group_rules.append(child)
+                branches.append("\\w*()" if token == "*" else "(?!\\w)()")
+            elif token is self.SEPARATOR:
+                branches.append("[\\s-]*" + self._node_pattern(child))
+            elif token == "е":
+                branches.append("[её]" + self._node_pattern(child))
+            else:
+                branches.append(re.escape(token) + self._node_pattern(child))
+        return branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+    def classify(self, prompt: str) -> SizeMatch:
+        best = None
+        for match in self.pattern.finditer(prompt.lower()):
+            index = self._group_rules[match.lastindex - 1]
+            if best is None or index < best[0]:
+                best = (index, match.group())
+                if index == 0:
+                    break
+        if best is None:
+            return self.default
+        rule = self.rules[best[0]]
+        return SizeMatch(rule["orientation"], rule["fal_size"], rule["openai_size"], best[1])
+
+
+prompt_classifier = PromptClassifier(IMAGE_SIZE_RULES, DEFAULT_IMAGE_SIZE)
 
 
 def detect_image_size(prompt: str) -> tuple[str, str]:
-    prompt_lower = prompt.lower()
-    vertical_keywords = [
-        "full body", "full-body", "standing", "walking", "в полный рост",
-        "стоит", "идёт", "идет", "whole body", "весь рост"
-    ]
-    landscape_keywords = [
-        "landscape", "panorama", "wide", "city", "street", "nature", "ocean",
-        "пейзаж", "панорама", "широкий", "горизонтальный", "город", "улица",
-        "природа", "океан", "море", "beach", "пляж", "forest", "лес",
-        "mountain", "гора", "sky", "небо"
-    ]
-    portrait_keywords = [
-        "portrait", "close-up", "closeup", "face", "headshot", "selfie",
-        "портрет", "крупный план", "лицо", "вертикальный",
-        "profile", "профиль"
-    ]
-    for kw in vertical_keywords:
-        if kw in prompt_lower:
-            return "portrait_16_9", "1024x1536"
-    for kw in landscape_keywords:
-        if kw in prompt_lower:
-            return "landscape_4_3", "1536x1024"
-    for kw in portrait_keywords:
-        if kw in prompt_lower:
-            return "portrait_4_3", "1024x1536"
-    return "square_hd", "1024x1024"
+    match = prompt_classifier.classify(prompt)
+    return match.fal_size, match.openai_size
 
 
 def tariff_keyboard() -> InlineKeyboardMarkup:
@@ -171,65 +1145,285 @@ def march8_keyboard() -> InlineKeyboardMarkup:
             text=t["name"],
             callback_data=f"m8_{key}"
         )])
+    buttons.append([InlineKeyboardButton(
+        text=f"✨ Все стили сразу ({len(MARCH8_TEMPLATES)} генерации)",
+        callback_data="m8all"
+    )])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def translate_prompt(user_prompt: str) -> str:
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split()).lower()
+
+
+def remember_translation(key: str, translated: str):
+    translation_cache[key] = translated
+    translation_cache.move_to_end(key)
+    while len(translation_cache) > TRANSLATION_CACHE_SIZE:
+        translation_cache.popitem(last=False)
+
+
+async def load_translation(key: str) -> str | None:
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a professional image prompt translator. "
-                        "If the prompt is in Russian, translate it to English. "
-                        "If it is already in English, return it as-is without changes. "
-                        "Do NOT summarize, shorten, or lose any details. "
-                        "Preserve ALL objects, accessories, clothing, atmosphere, and scene details exactly. "
-                        "Return ONLY the translated prompt, nothing else."
-                    )
-                },
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=800,
-            temperature=0.3
-        )
+        async with db_pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT translated FROM translations WHERE prompt_key = $1", key
+            )
+    except Exception as e:
+        logger.warning(f"Кэш переводов недоступен: {e}")
+        return None
+
+
+async def save_translation(key: str, translated: str):
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO translations (prompt_key, translated) VALUES ($1, $2)
+                ON CONFLICT (prompt_key) DO NOTHING
+            """, key, translated)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить перевод: {e}")
+
+
+async def openai_client():
+    """AsyncOpenAI создаётся при первом запросе, когда фоновый импорт уже закончился."""
+    global client
+    if client is None:
+        if "openai" in heavy_imports:
+            await heavy_imports["openai"]
+        from openai import AsyncOpenAI
+
+        if client is None:
+            client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=1)
+    return client
+
+
+async def translate_prompt(user_prompt: str) -> str:
+    # Без кириллицы промпт уже на английском — gpt-4o вернул бы его как есть
+    if not CYRILLIC_RE.search(user_prompt):
+        translation_stats["skipped"] += 1
+        return user_prompt
+
+    key = normalize_prompt(user_prompt)
+    cached = translation_cache.get(key)
+    if cached is not None:
+        translation_cache.move_to_end(key)
+        translation_stats["memory_hits"] += 1
+        return cached
+
+    with track_stage("translate_cache_db"):
+        cached = await load_translation(key)
+    if cached is not None:
+        remember_translation(key, cached)
+        translation_stats["db_hits"] += 1
+        return cached
+
+    translation_stats["misses"] += 1
+    try:
+        async with openai_chat_semaphore:
+            with track_stage("translate_api"):
+                response = await (await openai_client()).chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": (
+                                "You are a professional image prompt translator. "
+                                "If the prompt is in Russian, translate it to English. "
+                                "If it is already in English, return it as-is without changes. "
+                                "Do NOT summarize, shorten, or lose any details. "
+                                "Preserve ALL objects, accessories, clothing, atmosphere, and scene details exactly. "
+                                "Return ONLY the translated prompt, nothing else."
+                            )
+                        },
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    max_tokens=800,
+                    temperature=0.3,
+                    timeout=OPENAI_TRANSLATE_TIMEOUT,
+                )
         translated = response.choices[0].message.content.strip()
         logger.info(f"Промпт переведён: '{user_prompt[:50]}...' -> '{translated[:50]}...'")
+        remember_translation(key, translated)
+        await save_translation(key, translated)
         return translated
     except Exception as e:
         logger.warning(f"Перевод не удался: {e}")
         return user_prompt
 
 
-async def generate_with_flux_pulid(image_base64: str, prompt: str) -> bytes:
-    fal_size, _ = detect_image_size(prompt)
-    image_data_uri = f"data:image/jpeg;base64,{image_base64}"
+@dataclass
+class GenerationResult:
+    """Готовая картинка: ссылка на CDN провайдера и/или сами байты."""
 
-    async with httpx.AsyncClient(timeout=180) as http:
-        gen_response = await http.post(
-            "https://fal.run/fal-ai/flux-pulid",
-            headers={
-                "Authorization": f"Key {FAL_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "prompt": prompt + ", photorealistic, RAW photo, 8K resolution, sharp focus, natural skin texture, professional photography, cinematic lighting, preserve exact body proportions and figure, same body type as reference photo, do not slim or alter body shape",
-                "reference_image_url": image_data_uri,
-                "num_inference_steps": 30,
-                "guidance_scale": 7,
-                "true_cfg": 1,
-                "id_weight": 1.0,
-                "image_size": fal_size,
-                "num_images": 1,
-            }
-        )
+    url: str | None = None
+    data: bytes | None = None
+    image_size: str | None = None
 
-        logger.info(f"fal.ai статус: {gen_response.status_code}")
+    async def upload_file(self) -> BufferedInputFile:
+        data = self.data
+        if data is None:
+            with track_stage("result_download"):
+                try:
+                    data = await download_result(self.url)
+                except httpx.TransportError as e:
+                    raise FalTransientError(f"download: {e}") from e
+        if len(data) > RESULT_REENCODE_BYTES:
+            with track_stage("encode"):
+                loop = asyncio.get_running_loop()
+                data = await loop.run_in_executor(image_executor, encode_result, data)
+            return BufferedInputFile(data, filename=f"image.{RESULT_IMAGE_FORMAT.lower()}")
+        return BufferedInputFile(data, filename="image.png")
 
-        if gen_response.status_code == 500:
-            raise ValueError("Сервер fal.ai временно недоступен. Попробуйте ещё раз через минуту.")
+    async def input_file(self) -> str | BufferedInputFile:
+        if self.url is not None and RESULT_DELIVERY == "url":
+            return self.url
+        return await self.upload_file()
+
+
+FAL_UNAVAILABLE = "Сервер fal.ai временно недоступен. Попробуйте ещё раз через минуту."
+
+
+class FalTransientError(ValueError):
+    """Сбой, который имеет смысл повторить: 429/5xx, обрыв соединения, таймаут."""
+
+    def __init__(self, detail: str = ""):
+        super().__init__(FAL_UNAVAILABLE)
+        self.detail = detail
+
+
+class CircuitBreaker:
+    """После threshold сбоев подряд перестаёт пускать запросы на reset_timeout секунд."""
+
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "closed":
+            return True
+        if self.state == "open" and now - self.opened_at < self.reset_timeout:
+            return False
+        # Полуоткрыт: пропускаем один пробный запрос (или новый, если пробный потерялся)
+        if self.state == "open" or now - self.probe_started > FAL_TIMEOUT:
+            self.state = "half_open"
+            self.probe_started = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("fal.ai снова отвечает — предохранитель закрыт")
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            logger.warning(f"fal.ai недоступен ({self.failures} сбоев подряд) — предохранитель открыт")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            FAL_BREAKER_OPENS.inc()
+
+
+class LatencyWindow:
+    """Скользящее окно длительностей успешных запросов."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, value: float):
+        self._samples.append(value)
+
+    def quantile(self, q: float) -> float | None:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+FAL_RETRIES_TOTAL = Counter("bot_fal_retries_total", "Повторы запросов к fal.ai после временных сбоев")
+FAL_HEDGES_TOTAL = Counter("bot_fal_hedges_total", "Дублирующие запросы к fal.ai", ("winner",))
+FAL_BREAKER_OPENS = Counter("bot_fal_breaker_opens_total", "Срабатывания предохранителя fal.ai")
+FAL_BREAKER_REJECTS = Counter("bot_fal_breaker_rejects_total", "Генерации, отклонённые открытым предохранителем")
+FAL_FALLBACKS = Counter("bot_fal_fallbacks_total", "Генерации, переведённые с fal.ai на gpt-image-1")
+fal_breaker = CircuitBreaker(FAL_BREAKER_THRESHOLD, FAL_BREAKER_RESET)
+fal_latency = LatencyWindow()
+fal_cancel_tasks: set[asyncio.Task] = set()
+metrics_registry.extend([
+    FAL_RETRIES_TOTAL, FAL_HEDGES_TOTAL, FAL_BREAKER_OPENS, FAL_BREAKER_REJECTS, FAL_FALLBACKS,
+    Gauge("bot_fal_breaker_state", "Состояние предохранителя fal.ai: 0 — закрыт, 1 — полуоткрыт, 2 — открыт",
+          lambda: {(): CircuitBreaker.STATES[fal_breaker.state]}),
+])
+
+
+async def cancel_fal_request(cancel_url: str, headers: dict):
+    try:
+        await http_client.put(cancel_url, headers=headers)
+    except httpx.HTTPError:
+        pass
+
+
+def cancel_fal_request_later(cancel_url: str | None, headers: dict):
+    if cancel_url is None:
+        return
+    task = asyncio.create_task(cancel_fal_request(cancel_url, headers))
+    fal_cancel_tasks.add(task)
+    task.add_done_callback(fal_cancel_tasks.discard)
+
+
+async def fal_attempt(payload: dict, headers: dict) -> str:
+    """Одна попытка через очередь fal.ai: submit, ожидание, результат. Возвращает URL картинки."""
+    started = time.perf_counter()
+    cancel_url = None
+    try:
+        with track_stage("fal_submit", provider="flux"):
+            submit_response = await http_client.post(f"{FAL_QUEUE_URL}/{FAL_MODEL}", headers=headers, json=payload)
+        if submit_response.status_code == 429 or submit_response.status_code >= 500:
+            raise FalTransientError(f"submit: HTTP {submit_response.status_code}")
+        try:
+            submit_data = submit_response.json()
+            request_id = submit_data["request_id"]
+        except Exception:
+            raise ValueError(f"Неожиданный ответ fal.ai: {submit_response.text[:200]}")
+
+        requests_url = f"{FAL_QUEUE_URL}/{FAL_MODEL}/requests/{request_id}"
+        status_url = submit_data.get("status_url", f"{requests_url}/status")
+        response_url = submit_data.get("response_url", requests_url)
+        cancel_url = submit_data.get("cancel_url", f"{requests_url}/cancel")
+
+        interval = FAL_POLL_INTERVAL
+        with track_stage("fal_wait", provider="flux"):
+            while True:
+                await asyncio.sleep(interval)
+                interval = min(interval * 1.5, FAL_POLL_MAX_INTERVAL)
+                status_response = await http_client.get(status_url, headers=headers)
+                if status_response.status_code >= 500:
+                    continue
+                if status_response.status_code == 429:
+                    raise FalTransientError("status: HTTP 429")
+                try:
+                    status_data = status_response.json()
+                except ValueError:
+                    raise FalTransientError(f"status: HTTP {status_response.status_code}, не JSON")
+                if status_data.get("status") == "COMPLETED":
+                    break
+
+        with track_stage("fal_result", provider="flux"):
+            gen_response = await http_client.get(response_url, headers=headers)
+        cancel_url = None
+        logger.info(f"fal.ai статус: {gen_response.status_code} ({request_id})")
+
+        if gen_response.status_code == 429 or gen_response.status_code >= 500:
+            raise FalTransientError(f"result: HTTP {gen_response.status_code}")
 
         try:
             gen_data = gen_response.json()
@@ -239,70 +1433,1022 @@ async def generate_with_flux_pulid(image_base64: str, prompt: str) -> bytes:
         if "images" not in gen_data:
             raise ValueError(f"Ошибка fal.ai: {gen_data}")
 
-        result_url = gen_data["images"][0]["url"]
-        img_response = await http.get(result_url)
-        return img_response.content
+        fal_latency.add(time.perf_counter() - started)
+        return gen_data["images"][0]["url"]
+    except (asyncio.CancelledError, FalTransientError):
+        # Проигравший дубль, таймаут или повтор с новым submit: освобождаем место в очереди fal.ai
+        cancel_fal_request_later(cancel_url, headers)
+        raise
+    except httpx.TransportError as e:
+        cancel_fal_request_later(cancel_url, headers)
+        raise FalTransientError(f"{type(e).__name__}: {e}") from e
+
+
+async def fal_hedged_attempt(payload: dict, headers: dict, timeout: float) -> str:
+    """Попытка с таймаутом и, если включено, дублем после p95 успешных запросов."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    hedge_p95 = fal_latency.quantile(0.95) if FAL_HEDGE else None
+    hedge_at = loop.time() + max(FAL_HEDGE_MIN_DELAY, hedge_p95) if hedge_p95 is not None else None
+    primary = asyncio.create_task(fal_attempt(payload, headers))
+    tasks = {primary}
+    error: BaseException | None = None
+    hedged = False
+    try:
+        while tasks:
+            wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, _ = await asyncio.wait(
+                tasks, timeout=max(0.0, wake_at - loop.time()), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                tasks.discard(task)
+                if task.exception() is None:
+                    if hedged:
+                        FAL_HEDGES_TOTAL.inc(winner="primary" if task is primary else "hedge")
+                    return task.result()
+                error = task.exception()
+            if hedge_at is not None and loop.time() >= hedge_at and tasks:
+                hedge_at = None
+                hedged = True
+                logger.info("fal.ai отвечает дольше p95 — отправляю дублирующий запрос")
+                tasks.add(asyncio.create_task(fal_attempt(payload, headers)))
+            elif not done and loop.time() >= deadline:
+                raise FalTransientError(f"нет ответа за {timeout:.0f} с")
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def generate_with_flux_pulid(reference_image: bytes, prompt: str) -> GenerationResult:
+    if not fal_breaker.allow():
+        FAL_BREAKER_REJECTS.inc()
+        raise FalTransientError("предохранитель открыт")
+
+    size = prompt_classifier.classify(prompt)
+    logger.info(f"Формат {size.fal_size} ({size.orientation}, слово: {size.keyword!r})")
+    image_base64 = base64.b64encode(reference_image).decode("utf-8")
+    image_data_uri = f"data:image/jpeg;base64,{image_base64}"
+    headers = {"Authorization": f"Key {FAL_API_KEY}"}
+    payload = {
+        "prompt": prompt + ", photorealistic, RAW photo, 8K resolution, sharp focus, natural skin texture, professional photography, cinematic lighting, preserve exact body proportions and figure, same body type as reference photo, do not slim or alter body shape",
+        "reference_image_url": image_data_uri,
+        "num_inference_steps": 30,
+        "guidance_scale": 7,
+        "true_cfg": 1,
+        "id_weight": 1.0,
+        "image_size": size.fal_size,
+        "num_images": 1,
+    }
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FAL_TIMEOUT
+    attempt = 0
+    while True:
+        remaining = deadline - loop.time()
+        # Таймаут попытки подстраивается под p95: зависший запрос не съедает весь бюджет
+        p95 = fal_latency.quantile(0.95)
+        timeout = remaining if p95 is None else min(remaining, max(FAL_MIN_ATTEMPT_TIMEOUT, 3 * p95))
+        try:
+            result_url = await fal_hedged_attempt(payload, headers, timeout)
+            break
+        except FalTransientError as e:
+            fal_breaker.record_failure()
+            backoff = random.uniform(0, FAL_RETRY_BACKOFF * 2 ** attempt)
+            if attempt >= FAL_RETRIES or loop.time() + backoff >= deadline or not fal_breaker.allow():
+                raise
+            attempt += 1
+            FAL_RETRIES_TOTAL.inc()
+            logger.warning(f"fal.ai: {e.detail} — повтор {attempt}/{FAL_RETRIES} через {backoff:.1f} с")
+            await asyncio.sleep(backoff)
+        except ValueError:
+            # Ошибка по содержимому (нет лица и т.п.) — сервис при этом здоров
+            fal_breaker.record_success()
+            raise
+    fal_breaker.record_success()
+
+    return GenerationResult(url=result_url, image_size=size.fal_size)
+
+
+async def generate_text_only(prompt: str) -> GenerationResult:
+    translated_prompt = await translate_prompt(prompt)
+    size = prompt_classifier.classify(prompt + " " + translated_prompt)
+    logger.info(f"Формат {size.openai_size} ({size.orientation}, слово: {size.keyword!r})")
+
+    with track_stage("openai_generate", provider="openai"):
+        result = await (await openai_client()).images.generate(
+            model="gpt-image-1",
+            prompt=translated_prompt,
+            size=size.openai_size,
+            quality="high",
+            timeout=OPENAI_IMAGE_TIMEOUT,
+        )
+    image_base64 = result.data[0].b64_json
+    return GenerationResult(data=base64.b64decode(image_base64), image_size=size.openai_size)
+
+
+async def send_result(message: types.Message, result: GenerationResult, caption: str) -> types.Message:
+    """Отправляет картинку ссылкой, а если Telegram не смог её скачать — загрузкой байтов."""
+    with track_stage("tg_send"):
+        photo = await result.input_file()
+        if isinstance(photo, str):
+            try:
+                return await message.answer_photo(photo, caption=caption, parse_mode="Markdown")
+            except TelegramBadRequest as e:
+                logger.warning(f"Telegram не принял ссылку на результат: {e}")
+                photo = await result.upload_file()
+        return await message.answer_photo(photo, caption=caption, parse_mode="Markdown")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+QUEUE_FULL_TEXT = "😔 Сейчас очень много желающих — очередь заполнена. Попробуй через пару минут!"
+
+
+@dataclass
+class GenerationJob:
+    user_id: int
+    provider: str
+    run: Callable[[], Awaitable[GenerationResult]]
+    future: asyncio.Future
+    status_message: types.Message | None = None
+    position: int = 0
+    notified_position: int = 0
+    context: contextvars.Context | None = None
+    submitted_at: float = 0.0
+
+
+class GenerationScheduler:
+    """Очереди генераций с отдельным пулом воркеров на каждого провайдера.
+
+    Лимиты воркеров защищают от превышения rate limit у fal.ai и OpenAI,
+    а ограничение длины очереди — от бесконечного роста корутин. Внутри
+    провайдера у каждого пользователя своя очередь, и воркеры обходят их
+    по кругу, так что много заявок одного не задерживают остальных.
+    """
+
+    def __init__(self, limits: dict[str, int], max_queue: int):
+        self.limits = limits
+        self.max_queue = max_queue
+        self.running = {provider: 0 for provider in limits}
+        self._pending: dict[str, OrderedDict[int, deque[GenerationJob]]] = {
+            provider: OrderedDict() for provider in limits
+        }
+        self._signals: dict[str, asyncio.Queue] = {provider: asyncio.Queue() for provider in limits}
+        self._workers: list[asyncio.Task] = []
+        self._edits: set[asyncio.Task] = set()
+
+    def start(self):
+        for provider, limit in self.limits.items():
+            for _ in range(limit):
+                self._workers.append(asyncio.create_task(self._worker(provider)))
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def submit(
+        self,
+        user_id: int,
+        provider: str,
+        run: Callable[[], Awaitable[GenerationResult]],
+        status_message: types.Message | None = None,
+    ) -> GenerationJob:
+        free = self.limits[provider] - self.running[provider]
+        if self.queue_depth(provider) + 1 - free > self.max_queue:
+            raise QueueFullError(provider)
+        job = GenerationJob(user_id, provider, run, asyncio.get_running_loop().create_future(), status_message)
+        job.context = contextvars.copy_context()
+        job.submitted_at = time.perf_counter()
+        self._pending[provider].setdefault(user_id, deque()).append(job)
+        # Позиция 0 — есть свободный воркер, генерация стартует сразу
+        job.position = max(0, self._ordered(provider).index(job) + 1 - free)
+        if job.position:
+            job.notified_position = job.position
+            self._edit_status(job, f"⏳ Ты #{job.position} в очереди. Скоро начну генерацию!")
+        self._signals[provider].put_nowait(None)
+        return job
+
+    def queue_depth(self, provider: str) -> int:
+        return sum(len(jobs) for jobs in self._pending[provider].values())
+
+    def _ordered(self, provider: str) -> list[GenerationJob]:
+        """Заявки в том порядке, в котором их возьмут воркеры."""
+        queues = list(self._pending[provider].values())
+        ordered = []
+        for round_number in range(max((len(jobs) for jobs in queues), default=0)):
+            ordered.extend(jobs[round_number] for jobs in queues if round_number < len(jobs))
+        return ordered
+
+    def _next_job(self, provider: str) -> GenerationJob:
+        pending = self._pending[provider]
+        user_id, jobs = next(iter(pending.items()))
+        job = jobs.popleft()
+        if jobs:
+            pending.move_to_end(user_id)
+        else:
+            del pending[user_id]
+        return job
+
+    async def _worker(self, provider: str):
+        signal = self._signals[provider]
+        while True:
+            await signal.get()
+            job = self._next_job(provider)
+            if job.future.done():
+                # Ждавший заявку отменён — платный вызов провайдера уже никому не нужен
+                self._update_positions(provider)
+                continue
+            self.running[provider] += 1
+            labels = job.context.get(generation_labels, {})
+            STAGE_SECONDS.observe(
+                time.perf_counter() - job.submitted_at, stage="queue_wait", provider=provider,
+                kind=labels.get("kind", "none"), outcome="ok",
+            )
+            self._update_positions(provider)
+            if job.notified_position:
+                self._edit_status(job, "⏳ Твоя очередь подошла — генерирую...")
+            try:
+                # Задача получает контекст отправителя, чтобы замеры этапов знали provider и kind
+                result = await asyncio.create_task(job.run(), context=job.context)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                # Ждавший мог отмениться за время генерации: воркер при этом должен жить дальше
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.running[provider] -= 1
+
+    def _update_positions(self, provider: str):
+        for position, job in enumerate(self._ordered(provider), start=1):
+            job.position = position
+            if job.notified_position and job.notified_position != position and position <= GEN_QUEUE_STATUS_UPDATES:
+                job.notified_position = position
+                self._edit_status(job, f"⏳ Ты #{position} в очереди. Скоро начну генерацию!")
+
+    def _edit_status(self, job: GenerationJob, text: str):
+        if job.status_message is None:
+            return
 
+        async def edit():
+            try:
+                await job.status_message.edit_text(text)
+            except Exception as e:
+                logger.debug(f"[{job.user_id}] Статус не обновлён: {e}")
 
-async def generate_text_only(prompt: str) -> bytes:
-    translated_prompt = translate_prompt(prompt)
-    _, openai_size = detect_image_size(prompt + " " + translated_prompt)
+        task = asyncio.create_task(edit())
+        self._edits.add(task)
+        task.add_done_callback(self._edits.discard)
 
-    result = client.images.generate(
-        model="gpt-image-1",
-        prompt=translated_prompt,
-        size=openai_size,
-        quality="high",
-    )
-    image_base64 = result.data[0].b64_json
-    return base64.b64decode(image_base64)
 
+scheduler = GenerationScheduler(
+    {"flux": GEN_FLUX_CONCURRENCY, "openai": GEN_OPENAI_CONCURRENCY},
+    GEN_QUEUE_MAX,
+)
 
-async def process_generation(message: types.Message, user_id: int, prompt: str, is_template: bool = False):
-    credits = await get_credits(user_id)
-    if credits <= 0:
-        await message.answer(
-            "💳 У тебя закончились генерации!\n\nПополни баланс командой /buy 😊"
-        )
-        return
 
-    await message.answer(f"⏳ Генерирую открытку... (осталось: {credits})")
+class ResultCache:
+    """Готовые открытки: ключ (хэш фото, промпт, размер) -> file_id в Telegram.
 
-    try:
-        if user_id in user_photos:
-            saved_base64 = user_photos[user_id]
-            image_bytes = await generate_with_flux_pulid(saved_base64, prompt)
-            if not is_template:
-                del user_photos[user_id]
-        else:
-            image_bytes = await generate_text_only(prompt)
+    inflight хранит future ещё идущих генераций с тем же ключом, чтобы
+    повторное нажатие кнопки ждало их результат, а не платило за новый вызов.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.inflight: dict[str, asyncio.Future] = {}
+        self._entries: OrderedDict[str, str] = OrderedDict()
+
+    @staticmethod
+    def key(reference_image: bytes, prompt: str) -> str:
+        fal_size, _ = detect_image_size(prompt)
+        digest = hashlib.sha256(reference_image)
+        digest.update(f"\0{fal_size}\0{prompt}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        file_id = self._entries.get(key)
+        if file_id is not None:
+            self._entries.move_to_end(key)
+        return file_id
 
-        await use_credit(user_id)
-        remaining = await get_credits(user_id)
+    def put(self, key: str, file_id: str):
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
 
-        photo_file = BufferedInputFile(image_bytes, filename="image.png")
+    def discard(self, key: str):
+        self._entries.pop(key, None)
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE)
+
+
+@dataclass
+class GenerationRecord:
+    """Строка generations: порядок полей совпадает с колонками COPY."""
+
+    user_id: int
+    prompt: str
+    translated_prompt: str | None = None
+    template_key: str | None = None
+    image_size: str | None = None
+    provider: str | None = None
+    latency_ms: int | None = None
+    file_id: str | None = None
+
+
+HISTORY_RECORDS = Counter("bot_history_records_total", "Записи истории генераций", ("status",))
+metrics_registry.append(HISTORY_RECORDS)
+
+
+class HistoryWriter:
+    """Копит записи истории в памяти и пишет их в generations пачками через COPY.
+
+    add() не ждёт БД, поэтому история не добавляет задержки к генерации.
+    Если БД недоступна, записи ждут следующей попытки, но не больше max_pending.
+    """
+
+    def __init__(self, batch_size: int, interval: float, max_pending: int):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending: list[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def add(self, record: GenerationRecord):
+        if len(self.pending) >= self.max_pending:
+            HISTORY_RECORDS.inc(status="dropped")
+            return
+        self.pending.append(astuple(record))
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                async with db_pool.acquire() as conn:
+                    await conn.copy_records_to_table(
+                        "generations", records=batch, columns=[f.name for f in fields(GenerationRecord)]
+                    )
+                del self.pending[:len(batch)]
+                HISTORY_RECORDS.inc(len(batch), status="written")
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.warning(f"Не удалось записать историю генераций ({len(self.pending)} записей): {e}")
+        finally:
+            # stop_services ждёт эту задачу до закрытия пула: остаток успевает записаться
+            if self.pending:
+                await self.flush()
+
+
+history_writer = HistoryWriter(HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_MAX_PENDING)
+
+
+def db_pool_usage() -> dict[tuple[str, ...], float]:
+    if db_pool is None:
+        return {}
+    idle = db_pool.get_idle_size()
+    return {("in_use",): db_pool.get_size() - idle, ("idle",): idle}
+
+
+metrics_registry.extend([
+    Gauge("bot_generations_in_flight", "Генерации, которые сейчас выполняются",
+          lambda: {(p,): n for p, n in scheduler.running.items()}, ("provider",)),
+    Gauge("bot_generation_queue_depth", "Генерации, ждущие свободного воркера",
+          lambda: {(p,): scheduler.queue_depth(p) for p in scheduler.limits}, ("provider",)),
+    Gauge("bot_db_pool_connections", "Соединения пула asyncpg", db_pool_usage, ("state",)),
+    Gauge("bot_photo_store_entries", "Фото в памяти", lambda: {(): photo_store.stats()["entries"]}),
+    Gauge("bot_photo_store_bytes", "Байты фото в памяти", lambda: {(): photo_store.stats()["bytes"]}),
+    Gauge("bot_translations_total", "Переводы промптов по источнику",
+          lambda: {(k,): v for k, v in translation_stats.items()}, ("result",), "counter"),
+])
+
+
+async def send_cached_result(message: types.Message, user_id: int, file_id: str) -> bool:
+    reservation = None
+    if RESULT_CACHE_CHARGE:
+        reservation = await reserve_credits(user_id, reason="cached")
+        if reservation is None:
+            await message.answer(
+                "💳 У тебя закончились генерации!\n\nПополни баланс командой /buy 😊"
+            )
+            return True
+    remaining = reservation.remaining if reservation else await get_credits(user_id)
+    try:
         await message.answer_photo(
-            photo_file,
+            file_id,
             caption=f"✅ Готово! Осталось: *{remaining} генераций*",
             parse_mode="Markdown"
         )
+    except Exception as e:
+        logger.warning(f"[{user_id}] Не удалось отправить открытку из кэша: {e}")
+        if reservation:
+            await reservation.refund()
+        return False
+    if reservation:
+        reservation.commit()
+    return True
+
+
+def observe_generation(started: float, outcome: str):
+    labels = generation_labels.get()
+    GENERATION_SECONDS.observe(
+        time.perf_counter() - started,
+        provider=labels.get("provider", "none"),
+        kind=labels.get("kind", "none"),
+        outcome=outcome,
+    )
 
+
+async def process_generation(
+    message: types.Message,
+    user_id: int,
+    prompt: str,
+    template_key: str | None = None,
+    source_prompt: str | None = None,
+):
+    """prompt уже на английском; source_prompt — исходный текст пользователя для истории."""
+    started = time.perf_counter()
+    is_template = template_key is not None
+    reference_image = await photo_store.get(user_id)
+    generation_labels.set({
+        "provider": "flux" if reference_image is not None else "openai",
+        "kind": "template" if is_template else "free",
+    })
+    record = GenerationRecord(
+        user_id, source_prompt or prompt, translated_prompt=prompt, template_key=template_key
+    )
+    if not is_template or reference_image is None:
+        await run_generation(message, user_id, prompt, reference_image, record)
+        return
+
+    cache_key = ResultCache.key(reference_image, prompt)
+    file_id = result_cache.get(cache_key)
+    if file_id is None and cache_key in result_cache.inflight:
+        file_id = await asyncio.shield(result_cache.inflight[cache_key])
+    if file_id is not None:
+        if await send_cached_result(message, user_id, file_id):
+            observe_generation(started, "cached")
+            record.image_size, _ = detect_image_size(prompt)
+            record.provider = "cache"
+            record.latency_ms = int((time.perf_counter() - started) * 1000)
+            record.file_id = file_id
+            history_writer.add(record)
+            return
+        result_cache.discard(cache_key)
+
+    flight = asyncio.get_running_loop().create_future()
+    result_cache.inflight[cache_key] = flight
+    file_id = None
+    try:
+        file_id = await run_generation(message, user_id, prompt, reference_image, record)
+    finally:
+        result_cache.inflight.pop(cache_key, None)
+        flight.set_result(file_id)
+    if file_id is not None:
+        result_cache.put(cache_key, file_id)
+
+
+async def run_generation(
+    message: types.Message,
+    user_id: int,
+    prompt: str,
+    reference_image: bytes | None,
+    record: GenerationRecord,
+) -> str | None:
+    started = time.perf_counter()
+    is_template = record.template_key is not None
+    with track_stage("reserve"):
+        reservation = await reserve_credits(user_id)
+    if reservation is None:
+        await message.answer(
+            "💳 У тебя закончились генерации!\n\nПополни баланс командой /buy 😊"
+        )
+        observe_generation(started, "no_credits")
+        return None
+
+    try:
+        status = await message.answer(f"⏳ Генерирую открытку... (осталось: {reservation.remaining})")
+        if reference_image is not None:
+            job = scheduler.submit(
+                user_id, "flux", lambda: generate_with_flux_pulid(reference_image, prompt), status
+            )
+        else:
+            job = scheduler.submit(user_id, "openai", lambda: generate_text_only(prompt), status)
+
+        try:
+            result = await job.future
+        except FalTransientError as e:
+            if not (FAL_FALLBACK_TEXT and reference_image is not None and not is_template):
+                raise
+            logger.warning(f"[{user_id}] fal.ai недоступен ({e.detail}) — генерирую через gpt-image-1")
+            FAL_FALLBACKS.inc()
+            reference_image = None
+            await status.edit_text("⚠️ Сервис с сохранением лица сейчас недоступен — генерирую по описанию...")
+            job = scheduler.submit(user_id, "openai", lambda: generate_text_only(prompt), status)
+            result = await job.future
+        if reference_image is not None and not is_template:
+            await photo_store.discard(user_id)
+
+        sent = await send_result(message, result, f"✅ Готово! Осталось: *{reservation.remaining} генераций*")
+        reservation.commit()
+        observe_generation(started, "ok")
+        record.image_size = result.image_size
+        record.provider = job.provider
+        record.latency_ms = int((time.perf_counter() - started) * 1000)
+        record.file_id = sent.photo[-1].file_id
+        history_writer.add(record)
+        return record.file_id
+
+    # И первая попытка, и переключение на gpt-image-1 могут упереться в полную очередь
+    except QueueFullError:
+        await reservation.refund(reason="queue_full")
+        await status.edit_text(QUEUE_FULL_TEXT)
+        observe_generation(started, "queue_full")
     except Exception as e:
         logger.error(f"[{user_id}] Ошибка: {e}", exc_info=True)
-        err = str(e)
-        if "no face detected" in err.lower() or "face" in err.lower():
-            await message.answer(
-                "⚠️ Не удалось найти лицо на фото.\n\n"
-                "Попробуйте другое фото — реальный портрет с чётким лицом 😊"
-            )
-        elif "content_policy" in err.lower() or "safety" in err.lower():
-            await message.answer("⚠️ Запрос нарушает правила контента. Попробуйте переформулировать.")
-        elif "billing" in err.lower() or "quota" in err.lower():
-            await message.answer("💳 Проблема с балансом. Проверьте аккаунт.")
-        elif "временно недоступен" in err:
-            await message.answer("⚠️ " + err)
+        observe_generation(started, "error")
+        await reservation.refund()
+        await report_generation_error(message, e)
+    finally:
+        # Отмена (остановка планировщика при деплое) не попадает в except Exception:
+        # списанная заранее генерация возвращается и в этом случае
+        if not reservation.settled:
+            await asyncio.shield(reservation.refund(reason="cancelled"))
+    return None
+
+
+async def report_generation_error(message: types.Message, e: Exception):
+    err = str(e)
+    if "no face detected" in err.lower() or "face" in err.lower():
+        await message.answer(
+            "⚠️ Не удалось найти лицо на фото.\n\n"
+            "Попробуйте другое фото — реальный портрет с чётким лицом 😊"
+        )
+    elif "content_policy" in err.lower() or "safety" in err.lower():
+        await message.answer("⚠️ Запрос нарушает правила контента. Попробуйте переформулировать.")
+    elif "billing" in err.lower() or "quota" in err.lower():
+        await message.answer("💳 Проблема с балансом. Проверьте аккаунт.")
+    elif "временно недоступен" in err:
+        await message.answer("⚠️ " + err)
+    else:
+        await message.answer(f"❌ Ошибка:\n`{err[:300]}`", parse_mode="Markdown")
+
+
+async def generate_all_styles(message: types.Message, user_id: int):
+    """Все открытки к 8 марта одним заходом: одно списание, параллельные генерации, один альбом."""
+    started = time.perf_counter()
+    reference_image = await photo_store.get(user_id)
+    if reference_image is None:
+        await message.answer(
+            "⚠️ Сначала отправь своё фото! Без фото не могу создать открытку с твоим лицом 😊"
+        )
+        return
+    generation_labels.set({"provider": "flux", "kind": "batch"})
+    templates = list(MARCH8_TEMPLATES.values())
+
+    with track_stage("reserve"):
+        reservation = await reserve_credits(user_id, len(templates))
+    if reservation is None:
+        await message.answer(
+            f"💳 Для всех стилей нужно {len(templates)} генерации, "
+            f"а у тебя {await get_credits(user_id)}.\n\nПополни баланс командой /buy 😊"
+        )
+        observe_generation(started, "no_credits")
+        return
+
+    keys = [ResultCache.key(reference_image, t["prompt"]) for t in templates]
+    template_keys = dict(zip(keys, MARCH8_TEMPLATES))
+    done = 0
+    flights: dict[str, asyncio.Future] = {}
+
+    async def update_status(text: str | None):
+        try:
+            if text is None:
+                await status.delete()
+            else:
+                await status.edit_text(text)
+        except Exception as e:
+            logger.debug(f"[{user_id}] Статус не обновлён: {e}")
+
+    async def generate(template: dict, key: str) -> str | GenerationResult:
+        nonlocal done
+        cached = result_cache.get(key)
+        if cached is None and key in result_cache.inflight:
+            cached = await asyncio.shield(result_cache.inflight[key])
+        if cached is not None:
+            return cached
+        # Открытки пакета идут через общий планировщик: его лимит воркеров
+        # и очередь по пользователям не дают пакету занять fal.ai целиком
+        flights[key] = result_cache.inflight[key] = asyncio.get_running_loop().create_future()
+        job = scheduler.submit(
+            user_id, "flux", lambda: generate_with_flux_pulid(reference_image, template["prompt"])
+        )
+        result = await job.future
+        done += 1
+        await update_status(f"⏳ Готово {done} из {len(templates)}...")
+        return result
+
+    # Одиночные запросы тех же открыток ждут file_id из отправленного альбома,
+    # а не запускают свою платную генерацию
+    sent_file_ids: dict[str, str] = {}
+    try:
+        status = await message.answer(f"⏳ Генерирую {len(templates)} открытки... (осталось: {reservation.remaining})")
+        results = await asyncio.gather(
+            *[generate(t, key) for t, key in zip(templates, keys)], return_exceptions=True
+        )
+        ready = []
+        failed = []
+        for template, key, result in zip(templates, keys, results):
+            if isinstance(result, BaseException):
+                logger.error(f"[{user_id}] Ошибка в стиле {template['name']}: {result}")
+                failed.append((template, result))
+            else:
+                ready.append((key, result))
+
+        if not ready:
+            await reservation.refund()
+            if any(isinstance(error, QueueFullError) for _, error in failed):
+                observe_generation(started, "queue_full")
+                await update_status(QUEUE_FULL_TEXT)
+                return
+            observe_generation(started, "error")
+            await update_status(None)
+            await report_generation_error(message, failed[0][1])
+            return
+
+        # Открытки из кэша оплачиваются по тем же правилам, что и одиночные
+        refund_count = len(failed) + (0 if RESULT_CACHE_CHARGE else sum(isinstance(r, str) for _, r in ready))
+        caption = f"✅ Готово! Осталось: *{reservation.remaining + refund_count} генераций*"
+
+        async def send_album(upload: bool) -> list[types.Message]:
+            async def prepare(result: str | GenerationResult) -> str | BufferedInputFile:
+                if isinstance(result, str):
+                    return result
+                return await (result.upload_file() if upload else result.input_file())
+
+            files = await asyncio.gather(*[prepare(result) for _, result in ready])
+            if len(files) == 1:
+                return [await message.answer_photo(files[0], caption=caption, parse_mode="Markdown")]
+            media = [InputMediaPhoto(media=file) for file in files]
+            media[0].caption = caption
+            media[0].parse_mode = "Markdown"
+            return await message.answer_media_group(media)
+
+        try:
+            with track_stage("tg_send"):
+                try:
+                    sent = await send_album(upload=False)
+                except TelegramBadRequest as e:
+                    if RESULT_DELIVERY != "url" or all(isinstance(r, str) or r.url is None for _, r in ready):
+                        raise
+                    logger.warning(f"Telegram не принял ссылки на результаты: {e}")
+                    sent = await send_album(upload=True)
+        except Exception as e:
+            logger.error(f"[{user_id}] Не удалось отправить альбом: {e}", exc_info=True)
+            observe_generation(started, "error")
+            await reservation.refund()
+            # Возможно, в альбоме был устаревший file_id из кэша
+            for template, key, result in zip(templates, keys, results):
+                if isinstance(result, str):
+                    result_cache.discard(key)
+            await message.answer("❌ Не удалось отправить открытки. Генерации возвращены на баланс.")
+            return
+        latency_ms = int((time.perf_counter() - started) * 1000)
+        for (key, result), sent_message in zip(ready, sent):
+            file_id = sent_message.photo[-1].file_id
+            cached = isinstance(result, str)
+            sent_file_ids[key] = file_id
+            if not cached:
+                result_cache.put(key, file_id)
+            prompt = MARCH8_TEMPLATES[template_keys[key]]["prompt"]
+            history_writer.add(GenerationRecord(
+                user_id, prompt, translated_prompt=prompt, template_key=template_keys[key],
+                image_size=detect_image_size(prompt)[0] if cached else result.image_size,
+                provider="cache" if cached else "flux", latency_ms=latency_ms, file_id=file_id,
+            ))
+
+        await update_status(None)
+        if refund_count:
+            await reservation.refund(refund_count, reason="batch_refund")
         else:
-            await message.answer(f"❌ Ошибка:\n`{err[:300]}`", parse_mode="Markdown")
+            reservation.commit()
+        if failed:
+            names = ", ".join(template["name"] for template, _ in failed)
+            await message.answer(f"⚠️ Не получились: {names}. Эти генерации возвращены на баланс.")
+        observe_generation(started, "partial" if failed else "ok")
+    finally:
+        for key, flight in flights.items():
+            result_cache.inflight.pop(key, None)
+            flight.set_result(sent_file_ids.get(key))
+        if not reservation.settled:
+            await asyncio.shield(reservation.refund(reason="cancelled"))
+
+
+@dataclass
+class TokenBucket:
+    tokens: float
+    updated_at: float
+    warned: bool = False
+
+
+THROTTLED_UPDATES = Counter("bot_throttled_updates_total", "Апдейты, отброшенные до хендлера", ("reason",))
+metrics_registry.append(THROTTLED_UPDATES)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отсекает флуд до хендлеров, то есть до запросов в БД, перевода и генерации.
+
+    У каждого пользователя token bucket на все сообщения и нажатия и не больше
+    одной генерации одновременно: пока хендлер с генерацией не завершился,
+    новые промпты и кнопки открыток отклоняются. Состояние своё у каждого
+    процесса, при нескольких webhook-воркерах лимиты действуют на воркер.
+    """
+
+    def __init__(self, burst: int, per_minute: float, max_users: int):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_users = max_users
+        self.buckets: dict[int, TokenBucket] = {}
+        self.generating: set[int] = set()
+
+    def take_token(self, user_id: int) -> TokenBucket | None:
+        """Возвращает корзину, если токена не хватило, иначе None."""
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_users:
+                self.prune(now)
+            bucket = self.buckets[user_id] = TokenBucket(self.burst, now)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+        bucket.updated_at = now
+        if bucket.tokens < 1:
+            return bucket
+        bucket.tokens -= 1
+        bucket.warned = False
+        return None
+
+    def prune(self, now: float):
+        # Корзина, простоявшая дольше времени полного пополнения, ничем не отличается от новой
+        idle = self.burst / self.rate if self.rate else float("inf")
+        for user_id in [uid for uid, b in self.buckets.items() if now - b.updated_at > idle]:
+            del self.buckets[user_id]
+
+    @staticmethod
+    def starts_generation(event: types.TelegramObject, data: dict[str, Any]) -> bool:
+        if isinstance(event, types.CallbackQuery):
+            return bool(event.data) and event.data.startswith("m8")
+        # В состоянии FSM (ожидание чека) текст уходит другому хендлеру
+        return bool(event.text) and not event.text.startswith("/") and data.get("raw_state") is None
+
+    async def reject(self, event: types.TelegramObject, text: str):
+        try:
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text, show_alert=True)
+            else:
+                await event.answer(text)
+        except Exception as e:
+            logger.debug(f"Не удалось ответить на отброшенный апдейт: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+
+        bucket = self.take_token(user.id)
+        if bucket is not None:
+            THROTTLED_UPDATES.inc(reason="rate")
+            # Предупреждаем один раз, остальное молча отбрасываем до пополнения
+            if not bucket.warned:
+                bucket.warned = True
+                await self.reject(event, "🐢 Слишком много сообщений — подожди немного.")
+            return None
+
+        if not self.starts_generation(event, data):
+            return await handler(event, data)
+        if user.id in self.generating:
+            THROTTLED_UPDATES.inc(reason="inflight")
+            await self.reject(event, "⏳ Подожди, предыдущая генерация ещё не готова.")
+            return None
+        self.generating.add(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            self.generating.discard(user.id)
+
+
+throttling = ThrottlingMiddleware(RATE_LIMIT_BURST, RATE_LIMIT_PER_MINUTE, RATE_LIMIT_MAX_USERS)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
+
+class RateLimiter:
+    """Общий token bucket для исходящих сообщений; RetryAfter от Telegram ставит на паузу всех."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Сообщения рассылки по исходу", ("status",))
+metrics_registry.append(BROADCAST_MESSAGES)
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+broadcast_tasks: dict[int, asyncio.Task] = {}
+
+
+class Broadcast:
+    """Рассылка одного сообщения всем пользователям.
+
+    user_id читаются страницами по возрастанию на отдельном соединении (пул остаётся
+    обычному трафику) и идут через ограниченную очередь в воркеры. Каждая страница —
+    короткий запрос: рассылка на час не держит снимок, мешающий autovacuum. Исход по
+    каждому пользователю пишется в broadcast_deliveries пачками, поэтому
+    прерванную рассылку можно продолжить: получат её все, кроме тех, кому она
+    уже доставлена или кто заблокировал бота, — ошибки (сеть, 5xx) повторяются.
+    При падении процесса могут повториться сообщения из последней незаписанной пачки.
+    """
+
+    FLUSH_SIZE = 100
+    PAGE_SIZE = 500
+
+    def __init__(self, broadcast_id: int, from_chat_id: int, message_id: int, admin_chat_id: int):
+        self.id = broadcast_id
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.admin_chat_id = admin_chat_id
+        self.counts = {"sent": 0, "blocked": 0, "failed": 0}
+        self.total = 0
+        self.started = time.monotonic()
+        self._results: list[tuple[int, int, str, str | None]] = []
+
+    def progress_text(self) -> str:
+        done = sum(self.counts.values())
+        elapsed = time.monotonic() - self.started
+        percent = f" из {self.total} ({done * 100 // self.total}%)" if self.total else ""
+        return (
+            f"📣 Рассылка #{self.id}: {done}{percent}\n"
+            f"✅ доставлено {self.counts['sent']}, 🚫 заблокировали {self.counts['blocked']}, "
+            f"❌ ошибок {self.counts['failed']}\n"
+            f"⚡ {done / elapsed if elapsed else 0:.1f} сообщ./с"
+        )
+
+    async def run(self):
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            # Второй процесс или повторный запуск той же рассылки не начнёт слать параллельно
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.id):
+                await bot.send_message(self.admin_chat_id, f"⚠️ Рассылка #{self.id} уже идёт.")
+                return
+            self.total = await conn.fetchval("""
+                SELECT count(*) FROM users u WHERE NOT EXISTS (
+                    SELECT 1 FROM broadcast_deliveries d
+                    WHERE d.broadcast_id = $1 AND d.user_id = u.user_id AND d.status IN ('sent', 'blocked')
+                )
+            """, self.id)
+            status = await bot.send_message(self.admin_chat_id, self.progress_text())
+            queue: asyncio.Queue[int | None] = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_CONCURRENCY)]
+            reporter = asyncio.create_task(self._report(status))
+            try:
+                last_user_id = 0
+                while True:
+                    rows = await conn.fetch("""
+                        SELECT u.user_id FROM users u WHERE u.user_id > $2 AND NOT EXISTS (
+                            SELECT 1 FROM broadcast_deliveries d
+                            WHERE d.broadcast_id = $1 AND d.user_id = u.user_id AND d.status IN ('sent', 'blocked')
+                        ) ORDER BY u.user_id LIMIT $3
+                    """, self.id, last_user_id, self.PAGE_SIZE)
+                    if not rows:
+                        break
+                    for record in rows:
+                        await queue.put(record["user_id"])
+                    last_user_id = rows[-1]["user_id"]
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in (*workers, reporter):
+                    task.cancel()
+                await self._flush()
+            async with db_pool.acquire() as pool_conn:
+                await pool_conn.execute(
+                    "UPDATE broadcasts SET status = 'done', finished_at = NOW() WHERE id = $1", self.id
+                )
+            await self._edit(status, self.progress_text() + "\n\n🏁 Рассылка завершена")
+            logger.info(f"Рассылка #{self.id} завершена: {self.counts}")
+        finally:
+            await conn.close()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while (user_id := await queue.get()) is not None:
+            status, error = await self._deliver(user_id)
+            self.counts[status] += 1
+            BROADCAST_MESSAGES.inc(status=status)
+            self._results.append((self.id, user_id, status, error))
+            if len(self._results) >= self.FLUSH_SIZE:
+                await self._flush()
+
+    async def _deliver(self, user_id: int) -> tuple[str, str | None]:
+        while True:
+            await broadcast_limiter.acquire()
+            try:
+                await bot.copy_message(user_id, self.from_chat_id, self.message_id)
+                return "sent", None
+            except TelegramRetryAfter as e:
+                logger.warning(f"Рассылка #{self.id}: flood limit, пауза {e.retry_after} с")
+                broadcast_limiter.pause(e.retry_after)
+            except TelegramForbiddenError as e:
+                return "blocked", str(e)[:200]
+            except Exception as e:
+                return "failed", str(e)[:200]
+
+    async def _flush(self):
+        results, self._results = self._results, []
+        if not results:
+            return
+        async with db_pool.acquire() as conn:
+            await conn.executemany("""
+                INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, error)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (broadcast_id, user_id) DO UPDATE
+                SET status = EXCLUDED.status, error = EXCLUDED.error, sent_at = NOW()
+            """, results)
+
+    async def _report(self, status: types.Message):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._edit(status, self.progress_text())
+
+    async def _edit(self, status: types.Message, text: str):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.debug(f"Прогресс рассылки не обновлён: {e}")
+
+
+def start_broadcast(broadcast: Broadcast):
+    async def run():
+        try:
+            await broadcast.run()
+        except asyncio.CancelledError:
+            logger.info(f"Рассылка #{broadcast.id} остановлена: {broadcast.counts}")
+            raise
+        except Exception as e:
+            logger.error(f"Рассылка #{broadcast.id} упала: {e}", exc_info=True)
+            await bot.send_message(broadcast.admin_chat_id, f"❌ Рассылка #{broadcast.id} прервана: {e}\n"
+                                                            f"Продолжить: /broadcast_resume {broadcast.id}")
+        finally:
+            broadcast_tasks.pop(broadcast.id, None)
+
+    broadcast_tasks[broadcast.id] = asyncio.create_task(run())
 
 
 class PaymentState(StatesGroup):
@@ -324,7 +2470,8 @@ async def cmd_start(message: types.Message):
             "🧑‍🎨 *С твоим фото* — отправь фото + описание, перенесу тебя в новую сцену с сохранением лица.\n\n"
             "⚠️ Для генерации с фото нужно *реальное фото* — рисунки и аниме не поддерживаются.\n\n"
             "💰 Купить генерации — /buy\n"
-            "💳 Баланс — /balance",
+            "💳 Баланс — /balance\n"
+            "🖼 Мои генерации — /history",
             parse_mode="Markdown"
         )
     else:
@@ -333,14 +2480,15 @@ async def cmd_start(message: types.Message):
             f"🌷 Открытки к 8 марта — /march8\n\n"
             f"💳 У тебя: *{credits} генераций*\n\n"
             "💰 Купить генерации — /buy\n"
-            "💳 Баланс — /balance",
+            "💳 Баланс — /balance\n"
+            "🖼 Мои генерации — /history",
             parse_mode="Markdown"
         )
 
 
 @dp.message(Command("march8"))
 async def cmd_march8(message: types.Message):
-    if message.from_user.id not in user_photos:
+    if not await photo_store.has(message.from_user.id):
         await message.answer(
             "🌷 *Открытки к 8 марта!*\n\n"
             "Сначала отправь своё фото — я сохраню его и предложу стили открыток 😊\n\n"
@@ -348,8 +2496,11 @@ async def cmd_march8(message: types.Message):
             parse_mode="Markdown"
         )
     else:
+        # Результат проверки лица сохранён вместе с фото, повторно не считаем
+        no_face = await photo_store.faces(message.from_user.id) == 0
         await message.answer(
-            "🌷 *Выбери стиль открытки к 8 марта:*",
+            "🌷 *Выбери стиль открытки к 8 марта:*"
+            + ("\n\n⚠️ На твоём фото я не нашёл лица — открытка может не получиться." if no_face else ""),
             parse_mode="Markdown",
             reply_markup=march8_keyboard()
         )
@@ -372,10 +2523,68 @@ async def cmd_balance(message: types.Message):
 
 @dp.message(Command("reset"))
 async def cmd_reset(message: types.Message):
-    user_photos.pop(message.from_user.id, None)
+    await photo_store.discard(message.from_user.id)
     await message.answer("🔄 Фото сброшено.")
 
 
+async def send_history_page(message: types.Message, user_id: int, before_id: int | None = None):
+    """Страница истории альбомом по file_id: ни генераций, ни загрузок файлов."""
+    # Последние генерации могут ещё ждать записи в памяти; если записать их не вышло,
+    # показываем то, что уже есть в БД, — записи дождутся фоновой попытки
+    try:
+        await history_writer.flush()
+    except Exception as e:
+        logger.warning(f"Не удалось записать историю перед показом ({len(history_writer.pending)} записей): {e}")
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT id, prompt, template_key, file_id, created_at FROM generations
+            WHERE user_id = $1 AND id < $2
+            ORDER BY id DESC
+            LIMIT $3
+        """, user_id, before_id or 2 ** 63 - 1, HISTORY_PAGE_SIZE + 1)
+    if not rows:
+        await message.answer(
+            "🖼 История пуста — здесь появятся твои открытки и картинки." if before_id is None
+            else "🖼 Более ранних генераций нет."
+        )
+        return
+
+    page = rows[:HISTORY_PAGE_SIZE]
+    media = []
+    for row in page:
+        template = MARCH8_TEMPLATES.get(row["template_key"] or "")
+        title = template["name"] if template else row["prompt"][:200]
+        media.append(InputMediaPhoto(media=row["file_id"], caption=f"{row['created_at']:%d.%m.%Y %H:%M} — {title}"))
+    try:
+        with track_stage("tg_send", kind="history"):
+            if len(media) == 1:
+                await message.answer_photo(media[0].media, caption=media[0].caption)
+            else:
+                await message.answer_media_group(media)
+    except TelegramBadRequest as e:
+        logger.warning(f"[{user_id}] Не удалось отправить историю: {e}")
+        await message.answer("❌ Не удалось показать историю, попробуй позже.")
+        return
+    if len(rows) > HISTORY_PAGE_SIZE:
+        await message.answer(
+            "Показать более ранние?",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"hist_{page[-1]['id']}")]
+            ])
+        )
+
+
+@dp.message(Command("history"))
+async def cmd_history(message: types.Message):
+    await send_history_page(message, message.from_user.id)
+
+
+@dp.callback_query(lambda c: c.data.startswith("hist_"))
+async def process_history_page(callback: types.CallbackQuery):
+    await callback.answer()
+    await send_history_page(callback.message, callback.from_user.id, int(callback.data[5:]))
+
+
 @dp.callback_query(lambda c: c.data.startswith("buy_"))
 async def process_buy(callback: types.CallbackQuery, state: FSMContext):
     tariff_key = callback.data.split("_")[1]
@@ -418,7 +2627,7 @@ async def process_march8_template(callback: types.CallbackQuery):
         await callback.answer("Ошибка")
         return
 
-    if user_id not in user_photos:
+    if not await photo_store.has(user_id):
         await callback.message.answer(
             "⚠️ Сначала отправь своё фото! Без фото не могу создать открытку с твоим лицом 😊"
         )
@@ -426,7 +2635,13 @@ async def process_march8_template(callback: types.CallbackQuery):
         return
 
     await callback.answer()
-    await process_generation(callback.message, user_id, template["prompt"], is_template=True)
+    await process_generation(callback.message, user_id, template["prompt"], template_key=template_key)
+
+
+@dp.callback_query(lambda c: c.data == "m8all")
+async def process_march8_all(callback: types.CallbackQuery):
+    await callback.answer()
+    await generate_all_styles(callback.message, callback.from_user.id)
 
 
 @dp.message(PaymentState.waiting_receipt)
@@ -467,8 +2682,7 @@ async def cmd_add_credits(message: types.Message):
         parts = message.text.split("_")
         target_id = int(parts[1])
         count = int(parts[2])
-        await add_credits(target_id, count)
-        credits = await get_credits(target_id)
+        credits = await add_credits(target_id, count)
         await message.answer(f"✅ Начислено {count} генераций пользователю {target_id}")
         await bot.send_message(
             target_id,
@@ -482,6 +2696,66 @@ async def cmd_add_credits(message: types.Message):
         await message.answer("Ошибка. Формат: /add_USER_ID_COUNT")
 
 
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    source = message.reply_to_message
+    if source is None:
+        await message.answer(
+            "Ответь командой /broadcast на сообщение, которое нужно разослать.\n"
+            "Продолжить прерванную: /broadcast_resume ID, остановить: /broadcast_stop ID"
+        )
+        return
+    async with db_pool.acquire() as conn:
+        broadcast_id = await conn.fetchval(
+            "INSERT INTO broadcasts (from_chat_id, message_id) VALUES ($1, $2) RETURNING id",
+            source.chat.id, source.message_id,
+        )
+    start_broadcast(Broadcast(broadcast_id, source.chat.id, source.message_id, message.chat.id))
+
+
+@dp.message(Command("broadcast_resume"))
+async def cmd_broadcast_resume(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    try:
+        broadcast_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await message.answer("Формат: /broadcast_resume ID")
+        return
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT from_chat_id, message_id FROM broadcasts WHERE id = $1", broadcast_id)
+        if row is not None:
+            await conn.execute("UPDATE broadcasts SET status = 'running' WHERE id = $1", broadcast_id)
+    if row is None:
+        await message.answer(f"Рассылка #{broadcast_id} не найдена")
+        return
+    if broadcast_id in broadcast_tasks:
+        await message.answer(f"Рассылка #{broadcast_id} уже идёт")
+        return
+    start_broadcast(Broadcast(broadcast_id, row["from_chat_id"], row["message_id"], message.chat.id))
+
+
+@dp.message(Command("broadcast_stop"))
+async def cmd_broadcast_stop(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    try:
+        broadcast_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await message.answer("Формат: /broadcast_stop ID")
+        return
+    task = broadcast_tasks.get(broadcast_id)
+    if task is None:
+        await message.answer(f"Рассылка #{broadcast_id} в этом процессе не идёт")
+        return
+    task.cancel()
+    async with db_pool.acquire() as conn:
+        await conn.execute("UPDATE broadcasts SET status = 'stopped' WHERE id = $1", broadcast_id)
+    await message.answer(f"⏹ Рассылка #{broadcast_id} остановлена. Продолжить: /broadcast_resume {broadcast_id}")
+
+
 @dp.message()
 async def handle_message(message: types.Message):
     user_id = message.from_user.id
@@ -490,13 +2764,31 @@ async def handle_message(message: types.Message):
     if message.photo and not message.caption:
         try:
             photo = message.photo[-1]
-            file = await bot.get_file(photo.file_id)
-            downloaded = await bot.download_file(file.file_path)
-            image_bytes = downloaded.read()
-            image_base64 = compress_image(image_bytes)
-            user_photos[user_id] = image_base64
+            with track_stage("tg_get_file", kind="upload"):
+                file = await bot.get_file(photo.file_id)
+            with track_stage("tg_download", kind="upload"):
+                downloaded = await bot.download_file(file.file_path)
+                image_bytes = downloaded.read()
+            reference_image, faces = await prepare_reference_photo(image_bytes)
+            if faces == 0 and FACE_CHECK == "reject":
+                FACE_CHECKS.inc(verdict="rejected")
+                await message.answer(
+                    "⚠️ Не удалось найти лицо на фото.\n\n"
+                    "Пришли другое фото — реальный портрет с чётким лицом, смотрящим в камеру 😊"
+                )
+                return
+            if faces is not None:
+                FACE_CHECKS.inc(verdict="face" if faces else "no_face")
+            with track_stage("photo_store_put", kind="upload"):
+                await photo_store.put(user_id, reference_image, photo.file_id, faces)
 
-            if True:
+            if faces == 0:
+                await message.answer(
+                    "📸 Фото сохранено, но лицо на нём я не нашёл.\n\n"
+                    "Генерация с таким фото, скорее всего, не получится — лучше пришли "
+                    "реальный портрет с чётким лицом. Если уверен, что лицо видно, можно попробовать: /march8",
+                )
+            else:
                 await message.answer(
                     "📸 Фото сохранено!\n\n"
                     "🌷 Хочешь открытку к *8 марта*? Нажми /march8\n\n"
@@ -515,14 +2807,162 @@ async def handle_message(message: types.Message):
         if prompt.startswith("/"):
             return
 
-        await process_generation(message, user_id, translate_prompt(prompt))
+        await process_generation(message, user_id, await translate_prompt(prompt), source_prompt=prompt)
 
 
-async def main():
+background_tasks: list[asyncio.Task] = []
+# Модули, которые main.py импортирует внутри функций: при старте каждый грузится
+# в своём потоке, пока основной поток ждёт Postgres и уже принимает апдейты
+heavy_imports: dict[str, asyncio.Future] = {}
+# CPU на запуск интерпретатора и импорт модулей, в основном aiogram с моделями pydantic
+startup_seconds["modules_cpu"] = time.process_time()
+
+
+def heavy_modules() -> list[str]:
+    modules = ["openai", "PIL.ImageOps"]
+    if FACE_CHECK != "off" and importlib.util.find_spec("cv2") is not None:
+        modules.append("cv2")
+    return modules
+
+
+def import_heavy_module(name: str):
+    try:
+        importlib.import_module(name)
+    except Exception as e:
+        # Сломанный OpenCV (другая ABI numpy, нет libGL) не должен мешать OpenAI:
+        # ошибка остаётся в логе, а проверку лица выключит face_check_enabled
+        logger.warning(f"Фоновый импорт {name} не удался: {e}")
+
+
+def log_startup(started: float):
+    startup_seconds["total"] = time.perf_counter() - started
+    steps = ", ".join(f"{step} {seconds:.2f}" for step, seconds in startup_seconds.items())
+    logger.info(f"Запуск, с: {steps}")
+
+
+async def start_services():
+    global http_client, image_executor
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    heavy_imports.update(
+        (name, loop.run_in_executor(None, import_heavy_module, name)) for name in heavy_modules()
+    )
     await init_db()
-    logger.info("Бот запущен!")
-    await dp.start_polling(bot)
+    with startup_step("warm_known_users"):
+        await warm_known_users()
+    http_client = create_http_client()
+    image_executor = create_image_executor()
+    scheduler.start()
+    background_tasks.append(asyncio.create_task(photo_store_janitor()))
+    background_tasks.append(asyncio.create_task(history_writer.run()))
+    startup_seconds["services"] = time.perf_counter() - started
+    # Итог пишется, когда догрузится и фоновый импорт: бот к этому моменту уже работает
+    def imports_done(future: asyncio.Future):
+        startup_seconds["heavy_imports"] = time.perf_counter() - started
+        log_startup(started)
+
+    asyncio.gather(*heavy_imports.values()).add_done_callback(imports_done)
+
+
+async def stop_services():
+    tasks = [*background_tasks, *broadcast_tasks.values()]
+    for task in tasks:
+        task.cancel()
+    # Рассылкам нужно дописать статусы доставки, пока пул БД открыт
+    await asyncio.gather(*tasks, return_exceptions=True)
+    background_tasks.clear()
+    await scheduler.stop()
+    await http_client.aclose()
+    if client is not None:
+        await client.close()
+    image_executor.shutdown(wait=False, cancel_futures=True)
+    await db_pool.close()
+
+
+async def set_webhook():
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=False,
+    )
+    await bot.session.close()
+    logger.info(f"Вебхук установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+
+def serve_webhook(worker_index: int = 0):
+    async def on_startup(app: web.Application):
+        await start_services()
+        if METRICS_PORT:
+            app["metrics_runner"] = await start_metrics_server(METRICS_PORT + worker_index)
+
+    async def on_cleanup(app: web.Application):
+        if "metrics_runner" in app:
+            await app["metrics_runner"].cleanup()
+        await stop_services()
+
+    app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=WEBHOOK_BACKGROUND,
+        secret_token=WEBHOOK_SECRET,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    logger.info(f"Воркер {os.getpid()} слушает {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+    # reuse_port позволяет нескольким процессам слушать один порт, ядро делит соединения
+    web.run_app(app, host=WEB_HOST, port=WEB_PORT, reuse_port=WEB_WORKERS > 1, print=None)
+
+
+def run_webhook():
+    if WEBHOOK_URL:
+        asyncio.run(set_webhook())
+    if WEB_WORKERS <= 1:
+        serve_webhook()
+        return
+
+    workers = [multiprocessing.Process(target=serve_webhook, args=(index,)) for index in range(WEB_WORKERS)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Бот запущен в режиме webhook, воркеров: {WEB_WORKERS}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+async def start_metrics_server(port: int = METRICS_PORT) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    # У каждого воркера webhook свой порт (METRICS_PORT + номер воркера): при общем порту
+    # Prometheus попадал бы в случайный процесс, и счётчики скакали бы между рядами
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+
+async def main():
+    await start_services()
+    metrics_runner = None
+    try:
+        await bot.delete_webhook()
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server()
+        logger.info("Бот запущен!")
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await stop_services()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())